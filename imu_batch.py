@@ -0,0 +1,374 @@
+""" Batch post-processing of recorded sessions
+
+Converts every recording in a directory to a columnar ``.npz`` file with
+one array per channel, removes the linear drift of the selected channels
+and writes a statistics report for all of them::
+
+    python imu_batch.py RECORDINGS [-o OUTPUT] [-j WORKERS] [-d angle_z]
+
+Files are read in chunks of CHUNK_ROWS rows, so memory use does not
+depend on the file size. The cache of the output directory keeps the
+content and settings hash of every recording by file name, a recording
+is skipped when its own entry has the same hash and its output exists.
+"""
+import os
+import csv
+import glob
+import json
+import shutil
+import hashlib
+import zipfile
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+CHUNK_ROWS = 65536
+HASH_CHUNK = 1 << 20
+DRIFT_CHANNELS = ('angle_z',)
+PROCESSING_VERSION = 1
+
+OUTPUT_DIR = 'processed'
+CACHE_NAME = 'cache.json'
+REPORT_NAME = 'report.csv'
+SPECTRUM_SUFFIX = '_spectrum.csv'
+
+REPORT_FIELDS = (
+    'file', 'channel', 'count', 'mean', 'std', 'min', 'max', 'rms',
+    'drift_per_sample', 'residual_std'
+)
+
+
+class ChannelStats:
+    """ Streaming mean, variance and linear trend of each column
+
+    Chunks are merged with the pairwise update of Chan et al., which stays
+    accurate for any number of rows.
+    """
+    def __init__(self, channel_count):
+        """
+
+        :param channel_count:
+        """
+        self.count = 0
+        self.mean = np.zeros(channel_count)
+        self.m2 = np.zeros(channel_count)
+        self.minimum = np.full(channel_count, np.inf)
+        self.maximum = np.full(channel_count, -np.inf)
+        self.squares = np.zeros(channel_count)
+
+        # sample index statistics and co-moment for the trend
+        self.index_mean = 0.0
+        self.index_m2 = 0.0
+        self.comoment = np.zeros(channel_count)
+
+    def update(self, chunk):
+        """
+
+        :param chunk:
+            An array of shape (rows, channel_count)
+        """
+        n = len(chunk)
+        if not n:
+            return
+
+        index = np.arange(self.count, self.count + n, dtype=float)
+        mean = chunk.mean(axis=0)
+        index_mean = index.mean()
+        deviation = chunk - mean
+        index_deviation = index - index_mean
+
+        total = self.count + n
+        delta = mean - self.mean
+        index_delta = index_mean - self.index_mean
+        weight = self.count * n / total
+
+        self.m2 += (deviation ** 2).sum(axis=0) + delta ** 2 * weight
+        self.index_m2 += (index_deviation ** 2).sum() + \
+            index_delta ** 2 * weight
+        self.comoment += index_deviation @ deviation + \
+            index_delta * delta * weight
+        self.mean += delta * n / total
+        self.index_mean += index_delta * n / total
+        self.count = total
+
+        self.minimum = np.minimum(self.minimum, chunk.min(axis=0))
+        self.maximum = np.maximum(self.maximum, chunk.max(axis=0))
+        self.squares += (chunk ** 2).sum(axis=0)
+
+    @property
+    def slope(self):
+        if not self.index_m2:
+            return np.zeros_like(self.mean)
+        return self.comoment / self.index_m2
+
+    def summary(self, names):
+        """
+
+        :param names:
+        :returns:
+            A dict of per-channel statistics
+        """
+        count = max(self.count, 1)
+        residual = self.m2 - self.slope * self.comoment
+
+        return {
+            name: {
+                'count': self.count,
+                'mean': self.mean[i],
+                'std': np.sqrt(self.m2[i] / count),
+                'min': self.minimum[i],
+                'max': self.maximum[i],
+                'rms': np.sqrt(self.squares[i] / count),
+                'drift_per_sample': self.slope[i],
+                'residual_std': np.sqrt(max(residual[i], 0) / count)
+            }
+            for i, name in enumerate(names)
+        }
+
+
+def read_header(path):
+    """
+
+    :param path:
+    :return:
+    """
+    with open(path, newline='') as fobject:
+        return next(csv.reader(fobject))
+
+
+def iter_chunks(path, rows=CHUNK_ROWS):
+    """ Yields the data of a recording as float arrays of up to rows rows
+
+    :param path:
+    :param rows:
+    """
+    with open(path, newline='') as fobject:
+        reader = csv.reader(fobject)
+        next(reader)
+
+        chunk = []
+        for row in reader:
+            if row:
+                chunk.append(row)
+            if len(chunk) == rows:
+                yield np.array(chunk, dtype=float)
+                chunk = []
+        if chunk:
+            yield np.array(chunk, dtype=float)
+
+
+def hash_file(path, settings):
+    """
+
+    :param path:
+    :param settings:
+        Processing settings that change the output
+    :returns:
+        A (path, key) tuple
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+
+    with open(path, 'rb') as fobject:
+        for block in iter(lambda: fobject.read(HASH_CHUNK), b''):
+            digest.update(block)
+
+    return path, digest.hexdigest()
+
+
+def process_file(path, output_dir, drift_channels):
+    """ Converts one recording
+
+    The first pass collects the statistics and the drift, the second one
+    writes the corrected columns to temporary .npy files that are packed
+    into the .npz at the end.
+
+    :param path:
+    :param output_dir:
+    :param drift_channels:
+    :returns:
+        A (output name, statistics) tuple
+    """
+    names = read_header(path)
+    stats = ChannelStats(len(names))
+    for chunk in iter_chunks(path):
+        stats.update(chunk)
+
+    drift = np.zeros(len(names))
+    for i, name in enumerate(names):
+        if name in drift_channels:
+            drift[i] = stats.slope[i]
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    output = stem + '.npz'
+    temp_dir = os.path.join(output_dir, stem + '.tmp')
+    os.makedirs(temp_dir, exist_ok=True)
+
+    columns = [
+        np.lib.format.open_memmap(
+            os.path.join(temp_dir, name + '.npy'),
+            mode='w+',
+            dtype=np.float64,
+            shape=(stats.count,)
+        )
+        for name in names
+    ]
+
+    start = 0
+    for chunk in iter_chunks(path):
+        end = start + len(chunk)
+        chunk -= np.arange(start, end)[:, np.newaxis] * drift
+        for i, column in enumerate(columns):
+            column[start:end] = chunk[:, i]
+        start = end
+
+    for column in columns:
+        column.flush()
+    del columns
+
+    temp_output = os.path.join(output_dir, output + '.tmp')
+    with zipfile.ZipFile(temp_output, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as archive:
+        for name in names:
+            archive.write(os.path.join(temp_dir, name + '.npy'),
+                          name + '.npy')
+    os.replace(temp_output, os.path.join(output_dir, output))
+    shutil.rmtree(temp_dir)
+
+    return output, stats.summary(names)
+
+
+def load_cache(output_dir):
+    """
+
+    :param output_dir:
+    :return:
+    """
+    try:
+        with open(os.path.join(output_dir, CACHE_NAME)) as fobject:
+            return json.load(fobject)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(output_dir, cache):
+    """
+
+    :param output_dir:
+    :param cache:
+    """
+    path = os.path.join(output_dir, CACHE_NAME)
+    with open(path + '.tmp', 'w') as fobject:
+        json.dump(cache, fobject, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def write_report(output_dir, entries):
+    """
+
+    :param output_dir:
+    :param entries:
+        Cache entries of the processed recordings
+    """
+    path = os.path.join(output_dir, REPORT_NAME)
+    with open(path, 'w', newline='') as fobject:
+        writer = csv.writer(fobject)
+        writer.writerow(REPORT_FIELDS)
+
+        for entry in sorted(entries, key=lambda e: e['source']):
+            for channel, stats in entry['stats'].items():
+                writer.writerow(
+                    [entry['source'], channel] +
+                    [stats[field] for field in REPORT_FIELDS[2:]]
+                )
+
+
+def process_dir(input_dir, output_dir, workers=None,
+                drift_channels=DRIFT_CHANNELS):
+    """
+
+    :param input_dir:
+        Directory with the recordings
+    :param output_dir:
+    :param workers:
+        Number of worker processes, the number of CPUs by default
+    :param drift_channels:
+        Channels to remove the linear drift from
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    paths = sorted(
+        path for path in glob.glob(os.path.join(input_dir, '*.csv'))
+        if not path.endswith(SPECTRUM_SUFFIX)
+    )
+    settings = {
+        'version': PROCESSING_VERSION,
+        'drift_channels': sorted(drift_channels),
+        'chunk_rows': CHUNK_ROWS
+    }
+
+    cache = load_cache(output_dir)
+    entries = []
+
+    with ProcessPoolExecutor(workers) as pool:
+        keys = dict(pool.map(hash_file, paths, [settings] * len(paths)))
+
+        pending = {}
+        for path in paths:
+            entry = cache.get(os.path.basename(path))
+            if entry is not None and entry.get('hash') == keys[path] and \
+                    os.path.exists(os.path.join(output_dir, entry['output'])):
+                entries.append(entry)
+            else:
+                pending[path] = pool.submit(
+                    process_file, path, output_dir, drift_channels
+                )
+
+        print('{} recordings, {} cached, {} to process.'.format(
+            len(paths), len(entries), len(pending)
+        ))
+
+        for path, future in pending.items():
+            try:
+                output, stats = future.result()
+            except (OSError, ValueError) as e:
+                print('{}: {}'.format(path, e))
+                continue
+
+            entry = {
+                'source': os.path.basename(path),
+                'hash': keys[path],
+                'output': output,
+                'stats': stats
+            }
+            cache[entry['source']] = entry
+            entries.append(entry)
+            save_cache(output_dir, cache)
+            print('{} -> {}'.format(path, output))
+
+    write_report(output_dir, entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input_dir')
+    parser.add_argument('-o', '--output-dir')
+    parser.add_argument('-j', '--workers', type=int)
+    parser.add_argument(
+        '-d', '--drift',
+        default=','.join(DRIFT_CHANNELS),
+        help='comma separated channels to remove the linear drift from'
+    )
+    args = parser.parse_args()
+
+    process_dir(
+        args.input_dir,
+        args.output_dir or os.path.join(args.input_dir, OUTPUT_DIR),
+        args.workers,
+        tuple(channel for channel in args.drift.split(',') if channel)
+    )
+
+
+if __name__ == '__main__':
+    main()
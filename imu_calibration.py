@@ -0,0 +1,164 @@
+""" Gyro bias and accelerometer offset calibration
+
+While the sensor rests level with Z up, the gyro should read zero and the
+accelerometer (0, 0, 1) g. The Calibrator collects a window of samples
+with streaming statistics, and the resulting profile is stored per port
+in CALIBRATION_FILE. Its offsets are subtracted by the decoder, see
+imu_sample.decode_packet.
+"""
+import os
+import json
+import math
+import time
+
+from imu_sample import (
+    ACCEL_X,
+    ACCEL_Y,
+    ACCEL_Z,
+    VEL_X,
+    VEL_Y,
+    VEL_Z,
+    CHANNELS,
+    CHANNEL_COUNT,
+    new_sample
+)
+
+CALIBRATION_FILE = os.path.join(os.path.expanduser('~'), '.mpu6050-qt.json')
+CALIBRATION_SAMPLES = 500
+
+# expected reading at rest for every calibrated channel
+CALIBRATION_CHANNELS = {
+    ACCEL_X: 0.0,
+    ACCEL_Y: 0.0,
+    ACCEL_Z: 1.0,
+    VEL_X: 0.0,
+    VEL_Y: 0.0,
+    VEL_Z: 0.0
+}
+
+# noise above these limits means the sensor was moving
+MAX_ACCEL_NOISE = 0.05
+MAX_GYRO_NOISE = 2.0
+
+
+class Calibrator:
+    def __init__(self, offsets, sample_count=CALIBRATION_SAMPLES):
+        """
+
+        :param offsets:
+            Offsets the decoder subtracts while calibrating, added back to
+            get the raw readings
+        :param sample_count:
+            Length of the stationary window
+        """
+        self.offsets = [offsets[channel] for channel in CALIBRATION_CHANNELS]
+        self.channels = list(CALIBRATION_CHANNELS)
+        self.sample_count = sample_count
+
+        self.count = 0
+        self.mean = [0.0] * len(self.channels)
+        self.m2 = [0.0] * len(self.channels)
+
+    def update(self, batch, count):
+        """ Adds the samples of a batch using Welford's algorithm
+
+        :param batch:
+        :param count:
+        :returns:
+            True when the window is complete
+        """
+        count = min(count, self.sample_count - self.count)
+
+        for start in range(0, count * CHANNEL_COUNT, CHANNEL_COUNT):
+            self.count += 1
+            for i, channel in enumerate(self.channels):
+                value = batch[start + channel] + self.offsets[i]
+                delta = value - self.mean[i]
+                self.mean[i] += delta / self.count
+                self.m2[i] += delta * (value - self.mean[i])
+
+        return self.count >= self.sample_count
+
+    def profile(self):
+        """
+
+        :returns:
+            A dict with the bias and noise of every calibrated channel and
+            whether the sensor was stationary
+        """
+        noise = [math.sqrt(m2 / max(self.count - 1, 1)) for m2 in self.m2]
+        stationary = all(
+            value <= (MAX_ACCEL_NOISE if channel < VEL_X else MAX_GYRO_NOISE)
+            for channel, value in zip(self.channels, noise)
+        )
+
+        return {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'samples': self.count,
+            'stationary': stationary,
+            'bias': {
+                CHANNELS[channel]: mean - CALIBRATION_CHANNELS[channel]
+                for channel, mean in zip(self.channels, self.mean)
+            },
+            'noise': {
+                CHANNELS[channel]: value
+                for channel, value in zip(self.channels, noise)
+            }
+        }
+
+
+def load_profiles(path=CALIBRATION_FILE):
+    """
+
+    :param path:
+    :returns:
+        A dict of profiles by port
+    """
+    try:
+        with open(path) as fobject:
+            return json.load(fobject)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_profile(port, path=CALIBRATION_FILE):
+    """
+
+    :param port:
+    :param path:
+    :returns:
+        The profile of the port or None
+    """
+    return load_profiles(path).get(port)
+
+
+def save_profile(port, profile, path=CALIBRATION_FILE):
+    """
+
+    :param port:
+    :param profile:
+    :param path:
+    """
+    profiles = load_profiles(path)
+    profiles[port] = profile
+
+    with open(path + '.tmp', 'w') as fobject:
+        json.dump(profiles, fobject, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def profile_offsets(profile):
+    """
+
+    :param profile:
+        A profile or None for no correction
+    :returns:
+        A sample of offsets for the decoder
+    """
+    offsets = new_sample()
+
+    if profile is not None:
+        for name, bias in profile['bias'].items():
+            offsets[CHANNELS.index(name)] = bias
+
+    return offsets
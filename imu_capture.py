@@ -0,0 +1,392 @@
+""" Raw serial captures and decoder regression replay
+
+CaptureSerial wraps an open port and tees every read and write into a
+capture file, keeping the boundaries of the reads and their times. The
+file starts with a header and holds one record per call::
+
+    b'MPUC' | uint16 version | float64 start time
+    uint32 microseconds since the previous record |
+    uint16 write flag << 15 | length | data
+
+ReplaySerial serves a capture back with the same read boundaries, so the
+decoder sees exactly the byte stream of the session. Running this module
+replays IMU captures at full speed, reports the decoding throughput and
+compares the decoded samples with a golden CSV next to each capture::
+
+    python imu_capture.py CAPTURE_OR_DIR [...] [-u] [-r REPEAT]
+
+``-u`` writes the golden files from the current decoder.
+"""
+import io
+import os
+import csv
+import sys
+import glob
+import time
+import struct
+import argparse
+import threading
+
+from array import array
+
+from imu_sample import (
+    CSV_FIELDS,
+    ZERO_OFFSETS,
+    PacketReader,
+    decode_packet,
+    iter_rows,
+    new_sample
+)
+
+CAPTURE_MAGIC = b'MPUC'
+CAPTURE_VERSION = 1
+CAPTURE_EXT = '.cap'
+GOLDEN_EXT = '.golden'
+IMU_CAPTURE = 'imu'
+PLATFORM_CAPTURE = 'platform'
+
+HEADER = struct.Struct('<4sHd')
+RECORD = struct.Struct('<IH')
+WRITE_FLAG = 0x8000
+MAX_RECORD = WRITE_FLAG - 1
+MAX_DELAY = 0xFFFFFFFF
+
+
+def capture_path(directory, name):
+    """
+
+    :param directory:
+    :param name:
+        IMU_CAPTURE or PLATFORM_CAPTURE
+    :return:
+    """
+    return os.path.join(
+        directory,
+        time.strftime('%Y%m%d%H%M%S') + '_' + name + CAPTURE_EXT
+    )
+
+
+class CaptureWriter:
+    def __init__(self, path):
+        """
+
+        :param path:
+        """
+        self.fobject = open(path, 'wb')
+        self.fobject.write(
+            HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time())
+        )
+        self.last = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, data, write=False):
+        """
+
+        :param data:
+            Bytes read from or written to the port, may be empty for a
+            read that timed out
+        :param write:
+        """
+        with self.lock:
+            now = time.perf_counter()
+            delay = min(int((now - self.last) * 1e6), MAX_DELAY)
+            self.last = now
+
+            flag = WRITE_FLAG if write else 0
+            start = 0
+            while True:
+                chunk = data[start:start + MAX_RECORD]
+                self.fobject.write(RECORD.pack(delay, flag | len(chunk)))
+                self.fobject.write(chunk)
+                start += MAX_RECORD
+                delay = 0
+                if start >= len(data):
+                    break
+
+    def close(self):
+        """
+
+        """
+        with self.lock:
+            self.fobject.close()
+
+
+class CaptureSerial:
+    """ A serial port that records its traffic to a CaptureWriter
+
+    Everything except read and write is passed to the port.
+    """
+    def __init__(self, ser, path):
+        """
+
+        :param ser:
+            An open serial.Serial
+        :param path:
+            Capture file
+        """
+        self.ser = ser
+        try:
+            self.writer = CaptureWriter(path)
+        except OSError:
+            ser.close()
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def read(self, size=1):
+        """
+
+        :param size:
+        :return:
+        """
+        data = self.ser.read(size)
+        self.writer.record(data)
+        return data
+
+    def write(self, data):
+        """
+
+        :param data:
+        :return:
+        """
+        self.writer.record(data, write=True)
+        return self.ser.write(data)
+
+    def close(self):
+        """
+
+        """
+        try:
+            self.ser.close()
+        finally:
+            self.writer.close()
+
+
+def iter_records(path):
+    """ Yields the records of a capture
+
+    :param path:
+    :returns:
+        (seconds since the start, write, data) tuples
+    """
+    with open(path, 'rb') as fobject:
+        data = fobject.read()
+
+    magic, version, _ = HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError('Not a capture file: ' + path)
+
+    position = HEADER.size
+    elapsed = 0
+
+    while position + RECORD.size <= len(data):
+        delay, length = RECORD.unpack_from(data, position)
+        position += RECORD.size
+        elapsed += delay
+        size = length & MAX_RECORD
+
+        yield elapsed / 1e6, bool(length & WRITE_FLAG), \
+            data[position:position + size]
+        position += size
+
+
+class ReplaySerial:
+    """ Serves the reads of a capture as fast as they are requested
+
+    A read returns at most the rest of the current recorded read, so a
+    reader that calls the port the same way as during the session gets
+    the same chunks. Recorded timeouts return b''. Writes are ignored.
+    """
+    def __init__(self, path):
+        """
+
+        :param path:
+        """
+        self.reads = [
+            data for _, write, data in iter_records(path) if not write
+        ]
+        self.size = sum(len(data) for data in self.reads)
+        self.rewind()
+
+    def rewind(self):
+        """
+
+        """
+        self.index = 0
+        self.position = 0
+
+    @property
+    def exhausted(self):
+        return self.index >= len(self.reads)
+
+    @property
+    def in_waiting(self):
+        if self.exhausted:
+            return 0
+        return len(self.reads[self.index]) - self.position
+
+    def read(self, size=1):
+        """
+
+        :param size:
+        :return:
+        """
+        if self.exhausted:
+            return b''
+
+        data = self.reads[self.index]
+        chunk = data[self.position:self.position + size]
+        self.position += len(chunk)
+
+        if self.position >= len(data):
+            self.index += 1
+            self.position = 0
+
+        return chunk
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def replay(ser, offsets=ZERO_OFFSETS):
+    """ Decodes a capture the same way ImuReadThread reads the port
+
+    :param ser:
+        A ReplaySerial
+    :param offsets:
+    :returns:
+        A (samples, sample count, frame errors) tuple, samples is one
+        batch with all the decoded samples
+    """
+    reader = PacketReader(ser)
+    sample = new_sample()
+    samples = array('d')
+    count = 0
+    errors = 0
+
+    while True:
+        packet = reader.read()
+        if packet is None:
+            if ser.exhausted:
+                break
+            continue
+        errors += decode_packet(packet, sample, offsets)
+        samples.extend(sample)
+        count += 1
+
+    return samples, count, errors
+
+
+def format_rows(samples, count):
+    """
+
+    :param samples:
+    :param count:
+    :returns:
+        The lines of the CSV a recording of the samples would have
+    """
+    fobject = io.StringIO(newline='')
+    writer = csv.writer(fobject)
+    writer.writerow(CSV_FIELDS)
+    writer.writerows(iter_rows(samples, count))
+    return fobject.getvalue().splitlines()
+
+
+def check_capture(path, update=False, repeat=1):
+    """ Replays an IMU capture and compares it with its golden file
+
+    :param path:
+    :param update:
+        Write the golden file instead of comparing
+    :param repeat:
+        Number of replays, the fastest one is reported
+    :returns:
+        True if the output matches or the golden file was written
+    """
+    ser = ReplaySerial(path)
+    elapsed = float('inf')
+
+    for _ in range(max(repeat, 1)):
+        ser.rewind()
+        start = time.perf_counter()
+        samples, count, errors = replay(ser)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    lines = format_rows(samples, count)
+    golden = os.path.splitext(path)[0] + GOLDEN_EXT
+
+    print('{}: {} bytes, {} packets, {} frame errors, '
+          '{:.0f} packets/s, {:.2f} MB/s'.format(
+              path, ser.size, count, errors, count / elapsed,
+              ser.size / elapsed / 1e6
+          ))
+
+    if update:
+        with open(golden, 'w', newline='') as fobject:
+            fobject.write('\r\n'.join(lines) + '\r\n')
+        print('  golden written: ' + golden)
+        return True
+
+    try:
+        with open(golden, newline='') as fobject:
+            expected = fobject.read().splitlines()
+    except OSError as e:
+        print('  no golden file: {}'.format(e))
+        return False
+
+    for number, (line, expected_line) in enumerate(zip(lines, expected), 1):
+        if line != expected_line:
+            print('  line {} differs:'.format(number))
+            print('    got      ' + line)
+            print('    expected ' + expected_line)
+            return False
+
+    if len(lines) != len(expected):
+        print('  {} lines, expected {}'.format(len(lines), len(expected)))
+        return False
+
+    print('  OK')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'captures', nargs='+',
+        help='IMU captures or directories with them'
+    )
+    parser.add_argument('-u', '--update', action='store_true')
+    parser.add_argument('-r', '--repeat', type=int, default=1)
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.captures:
+        if os.path.isdir(path):
+            paths.extend(sorted(glob.glob(os.path.join(
+                path, '*_' + IMU_CAPTURE + CAPTURE_EXT
+            ))))
+        else:
+            paths.append(path)
+
+    failed = 0
+    for path in paths:
+        try:
+            passed = check_capture(path, args.update, args.repeat)
+        except (OSError, ValueError) as e:
+            print('{}: {}'.format(path, e))
+            passed = False
+        failed += not passed
+
+    print('{} captures, {} failed.'.format(len(paths), failed))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+""" Remote control of the application over HTTP
+
+Every command is a POST request to ``/<command>`` with an optional JSON
+object of parameters in the body. The reply is a JSON object with either
+a ``result`` or an ``error`` key::
+
+    curl -X POST localhost:5556/send_coords -d '{"coords": [10, -10, 0, 0]}'
+
+Requests are served on their own threads. The server only hands each
+command to a dispatch function and waits for it to be finished, so the
+dispatcher is free to run it on whichever thread owns the resource.
+A command that blocks takes a ``timeout`` parameter in seconds and the
+server waits for it that long plus COMMAND_MARGIN, otherwise up to
+COMMAND_TIMEOUT.
+"""
+import sys
+import json
+import time
+import threading
+import http.client
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTROL_HOST = 'localhost'
+CONTROL_PORT = 5556
+COMMAND_TIMEOUT = 10
+COMMAND_MARGIN = 2
+# wait of a blocking command without a timeout parameter
+DEFAULT_WAIT = COMMAND_TIMEOUT - COMMAND_MARGIN
+
+BENCHMARK_COUNT = 1000
+
+
+def command_timeout(params, timeout=COMMAND_TIMEOUT):
+    """
+
+    :param params:
+        Command parameters
+    :param timeout:
+        Time to wait for a command without a timeout parameter
+    :raises ValueError:
+        If the timeout parameter is not a non-negative number
+    :returns:
+        Time to wait for the command to finish in seconds
+    """
+    value = params.get('timeout')
+    if value is None:
+        return timeout
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            value < 0:
+        raise ValueError('timeout must be a non-negative number')
+    return max(timeout, value + COMMAND_MARGIN)
+
+
+class Command:
+    def __init__(self, name, params):
+        """
+
+        :param name:
+        :param params:
+        """
+        self.name = name
+        self.params = params
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None):
+        """
+
+        :param result:
+        """
+        self.result = result
+        self.done.set()
+
+    def fail(self, error):
+        """
+
+        :param error:
+        """
+        self.error = str(error)
+        self.done.set()
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        """
+
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.reply(400, {'error': 'Invalid JSON'})
+            return
+        if not isinstance(params, dict):
+            self.reply(400, {'error': 'Parameters must be an object'})
+            return
+
+        try:
+            timeout = command_timeout(params, self.server.command_timeout)
+        except ValueError as e:
+            self.reply(400, {'error': str(e)})
+            return
+
+        command = Command(self.path.strip('/'), params)
+        self.server.dispatch(command)
+
+        if not command.done.wait(timeout):
+            self.reply(504, {'error': 'Command timed out'})
+        elif command.error is not None:
+            self.reply(400, {'error': command.error})
+        else:
+            self.reply(200, {'result': command.result})
+
+    def reply(self, code, body):
+        """
+
+        :param code:
+        :param body:
+        """
+        data = json.dumps(body).encode()
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class ControlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dispatch, host=CONTROL_HOST, port=CONTROL_PORT,
+                 timeout=COMMAND_TIMEOUT):
+        """
+
+        :param dispatch:
+            Called with a Command on the request thread. It has to call
+            Command.finish or Command.fail, right away or later on from
+            another thread.
+        :param host:
+        :param port:
+        :param timeout:
+            Time to wait for a command without a timeout parameter to
+            finish in seconds
+        """
+        super().__init__((host, port), ControlRequestHandler)
+
+        self.dispatch = dispatch
+        self.command_timeout = timeout
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        """
+
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlClient:
+    """ Sends commands to a ControlServer over a persistent connection
+
+        Usage::
+
+            client = ControlClient()
+            client.call('connect_platform', port='COM3')
+            client.call('send_coords', coords=[100, -100, 0, 0])
+            client.call('get_position', timeout=0.1)
+            client.call('wait_move_done', timeout=30)
+    """
+    def __init__(self, host=CONTROL_HOST, port=CONTROL_PORT,
+                 timeout=COMMAND_TIMEOUT):
+        """
+
+        :param host:
+        :param port:
+        :param timeout:
+            Socket timeout for commands without a timeout parameter, it
+            is raised to cover the ones that have it
+        """
+        self.connection = http.client.HTTPConnection(host, port, timeout)
+        self.timeout = timeout
+
+    def call(self, name, **params):
+        """
+
+        :param name:
+            Command name
+        :param params:
+            Command parameters
+        :raises ControlError:
+            When the command fails
+        :raises ValueError:
+            If the timeout parameter is not a non-negative number
+        :returns:
+            The result of the command
+        """
+        timeout = command_timeout(params, self.timeout) + COMMAND_MARGIN
+        self.connection.timeout = timeout
+        if self.connection.sock is not None:
+            self.connection.sock.settimeout(timeout)
+
+        self.connection.request(
+            'POST',
+            '/' + name,
+            json.dumps(params).encode(),
+            {'Content-Type': 'application/json'}
+        )
+        response = json.loads(self.connection.getresponse().read())
+
+        if 'error' in response:
+            raise ControlError(response['error'])
+        return response['result']
+
+    def close(self):
+        """
+
+        """
+        self.connection.close()
+
+
+def benchmark(host=CONTROL_HOST, port=CONTROL_PORT, count=BENCHMARK_COUNT):
+    """ Measures command round trip latency
+
+    Runs against a ControlServer at the given address, or against a local
+    one with a trivial dispatcher when none is listening there.
+
+    :param host:
+    :param port:
+    :param count:
+        Number of commands to send
+    """
+    server = None
+    try:
+        client = ControlClient(host, port)
+        client.call('status')
+    except OSError:
+        server = ControlServer(lambda command: command.finish(), host, 0)
+        client = ControlClient(*server.server_address)
+        print('No server at {}:{}, using a local echo server.'.format(
+            host, port
+        ))
+
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        client.call('status')
+        latencies.append(time.perf_counter() - start)
+
+    client.close()
+    if server is not None:
+        server.close()
+
+    latencies.sort()
+    print('{} round trips: avg {:.3f} ms, median {:.3f} ms, '
+          '99% {:.3f} ms, max {:.3f} ms'.format(
+              count,
+              sum(latencies) / count * 1000,
+              latencies[count // 2] * 1000,
+              latencies[int(count * 0.99)] * 1000,
+              latencies[-1] * 1000
+          ))
+
+
+if __name__ == '__main__':
+    benchmark(*sys.argv[1:2], *[int(arg) for arg in sys.argv[2:4]])
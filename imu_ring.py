@@ -0,0 +1,355 @@
+""" Shared memory ring buffer of IMU samples
+
+The serial reader and decoder can run in their own process and write
+samples into a ring in ``multiprocessing.shared_memory``. Any number of
+readers in other processes attach to it by name and copy new samples out
+in one block per call, without pickling or per-sample objects.
+
+The block starts with five uint64 fields and the calibration offsets the
+writer applies, followed by the samples::
+
+    capacity | claimed | committed | discarded | owner pid |
+    CHANNEL_COUNT * float64 offsets |
+    capacity * CHANNEL_COUNT * float64 samples
+
+The writer bumps ``claimed`` before overwriting slots and ``committed``
+after, so a reader can tell exactly which of the samples it copied may
+have been overwritten meanwhile and counts them as missed. ``discarded``
+counts the runs of bytes the writer dropped while looking for a packet
+header, see imu_sample.PacketReader.
+
+A ring is named RING_NAME, or RING_NAME_<pid> when another running
+instance owns that name. SampleRing.name is the name to attach to.
+"""
+import os
+import sys
+import time
+
+from multiprocessing import shared_memory, resource_tracker
+
+import serial
+
+from imu_capture import CaptureSerial
+from imu_sample import (
+    CHANNEL_COUNT,
+    PacketReader,
+    decode_packet,
+    new_batch,
+    new_sample
+)
+
+RING_NAME = 'mpu6050_ring'
+RING_CAPACITY = 65536
+RING_READ_SIZE = 1024
+RING_POLL_INTERVAL = 0.005
+ACQUIRE_PORT_ERROR = 2
+
+CAPACITY, CLAIMED, COMMITTED, DISCARDED, OWNER = range(5)
+COUNTERS_SIZE = 5 * 8
+HEADER_SIZE = COUNTERS_SIZE + CHANNEL_COUNT * 8
+
+
+def owner_alive(pid):
+    """
+
+    :param pid:
+    :returns:
+        Whether the process is running
+    """
+    if os.name != 'posix':
+        # other systems free a block with its last handle
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError):
+        return True
+    return True
+
+
+def remove_stale(name):
+    """ Removes a block whose owner is gone
+
+    :param name:
+    :returns:
+        True if the block was removed, False if it is in use
+    """
+    memory = SampleRing.attach_memory(name)
+    try:
+        if memory.size < COUNTERS_SIZE:
+            alive = False
+        else:
+            counters = memory.buf[:COUNTERS_SIZE].cast('Q')
+            alive = owner_alive(counters[OWNER])
+            counters.release()
+    finally:
+        memory.close()
+
+    if alive:
+        return False
+
+    memory = shared_memory.SharedMemory(name)
+    memory.close()
+    memory.unlink()
+    return True
+
+
+class SampleRing:
+    def __init__(self, memory):
+        """
+
+        :param memory:
+            A SharedMemory block laid out as described in the module
+        """
+        self.memory = memory
+        self.counters = memory.buf[:COUNTERS_SIZE].cast('Q')
+        self.offsets = memory.buf[COUNTERS_SIZE:HEADER_SIZE].cast('d')
+        self.capacity = self.counters[CAPACITY]
+        self.samples = memory.buf[
+            HEADER_SIZE:HEADER_SIZE + self.capacity * CHANNEL_COUNT * 8
+        ].cast('d')
+
+    @classmethod
+    def create(cls, name=RING_NAME, capacity=RING_CAPACITY):
+        """ Creates a new ring
+
+        A block left with the same name by a process that is gone is
+        replaced. If its owner is still running, the ring gets the name
+        with this process id appended instead.
+
+        :param name:
+        :param capacity:
+            Number of samples
+        :raises FileExistsError:
+            If both names belong to running processes
+        :return:
+        """
+        size = HEADER_SIZE + capacity * CHANNEL_COUNT * 8
+
+        for candidate in (name, '{}_{}'.format(name, os.getpid())):
+            try:
+                memory = shared_memory.SharedMemory(candidate, True, size)
+            except FileExistsError:
+                if not remove_stale(candidate):
+                    continue
+                memory = shared_memory.SharedMemory(candidate, True, size)
+            break
+        else:
+            raise FileExistsError('Ring {} is in use'.format(name))
+
+        counters = memory.buf[:COUNTERS_SIZE].cast('Q')
+        counters[CAPACITY] = capacity
+        counters[CLAIMED] = counters[COMMITTED] = counters[DISCARDED] = 0
+        counters[OWNER] = os.getpid()
+        counters.release()
+
+        return cls(memory)
+
+    @classmethod
+    def attach(cls, name=RING_NAME, track=False):
+        """
+
+        :param name:
+        :param track:
+            Whether this process may remove the block at exit. Only
+            processes sharing the resource tracker of the owner, such as
+            its children, may leave this on.
+        :return:
+        """
+        return cls(cls.attach_memory(name, track))
+
+    @staticmethod
+    def attach_memory(name, track=False):
+        """
+
+        :param name:
+        :param track:
+            See attach
+        :return:
+        """
+        if sys.version_info >= (3, 13):
+            # noinspection PyArgumentList
+            return shared_memory.SharedMemory(name, track=track)
+
+        memory = shared_memory.SharedMemory(name)
+        if not track and os.name == 'posix':
+            # noinspection PyProtectedMember
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        """
+
+        """
+        self.samples.release()
+        self.offsets.release()
+        self.counters.release()
+        self.memory.close()
+
+    def unlink(self):
+        """
+
+        """
+        self.memory.unlink()
+
+
+class RingWriter:
+    def __init__(self, ring):
+        """
+
+        :param ring:
+        """
+        self.ring = ring
+        self.size = ring.capacity * CHANNEL_COUNT
+
+    def write(self, batch, count):
+        """
+
+        :param batch:
+            An array('d') with the samples back to back
+        :param count:
+            Number of samples to write, at most the ring capacity
+        """
+        counters = self.ring.counters
+        samples = self.ring.samples
+        seq = counters[COMMITTED]
+        counters[CLAIMED] = seq + count
+
+        data = memoryview(batch)[:count * CHANNEL_COUNT]
+        start = seq % self.ring.capacity * CHANNEL_COUNT
+        end = start + len(data)
+
+        if end <= self.size:
+            samples[start:end] = data
+        else:
+            split = self.size - start
+            samples[start:] = data[:split]
+            samples[:end - self.size] = data[split:]
+
+        counters[COMMITTED] = seq + count
+
+
+class RingReader:
+    def __init__(self, ring, read_size=RING_READ_SIZE):
+        """ Starts reading at the newest sample
+
+        :param ring:
+        :param read_size:
+            Maximum number of samples returned by one read
+        """
+        self.ring = ring
+        self.size = ring.capacity * CHANNEL_COUNT
+        self.batch = new_batch(read_size)
+        self.read_size = read_size
+
+        self.next_seq = ring.counters[COMMITTED]
+        self.missed = 0
+
+    def read(self):
+        """ Copies new samples to self.batch
+
+        :returns:
+            The number of samples in self.batch
+        """
+        counters = self.ring.counters
+        samples = self.ring.samples
+        capacity = self.ring.capacity
+
+        committed = counters[COMMITTED]
+        oldest = counters[CLAIMED] - capacity
+        if self.next_seq < oldest:
+            self.missed += oldest - self.next_seq
+            self.next_seq = oldest
+
+        count = min(committed - self.next_seq, self.read_size)
+        if count <= 0:
+            return 0
+
+        start = self.next_seq % capacity * CHANNEL_COUNT
+        end = start + count * CHANNEL_COUNT
+        view = memoryview(self.batch)
+
+        if end <= self.size:
+            view[:end - start] = samples[start:end]
+        else:
+            split = self.size - start
+            view[:split] = samples[start:]
+            view[split:end - start] = samples[:end - self.size]
+
+        # samples overwritten while copying are dropped from the front
+        torn = max(0, counters[CLAIMED] - capacity - self.next_seq)
+        self.next_seq += count
+
+        if torn:
+            torn = min(torn, count)
+            self.missed += torn
+            count -= torn
+            self.batch[:count * CHANNEL_COUNT] = \
+                self.batch[torn * CHANNEL_COUNT:(torn + count) * CHANNEL_COUNT]
+
+        return count
+
+    def wait(self, timeout=None, interval=RING_POLL_INTERVAL):
+        """ Reads new samples polling until there are some
+
+        :param timeout:
+        :param interval:
+        :return:
+            The number of samples in self.batch
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+
+        while True:
+            count = self.read()
+            if count or deadline is not None and \
+                    time.perf_counter() > deadline:
+                return count
+            time.sleep(interval)
+
+
+def acquire(port, baudrate, name, stop_event, capture=None):
+    """ Reads and decodes IMU packets into the ring until stopped
+
+    Runs as the target of a multiprocessing.Process.
+
+    :param port:
+    :param baudrate:
+    :param name:
+        Name of the ring created by the parent process
+    :param stop_event:
+        A multiprocessing.Event
+    :param capture:
+        File to record the raw port data to, see imu_capture
+    :returns:
+        Exits with ACQUIRE_PORT_ERROR if the port can not be opened
+    """
+    ring = SampleRing.attach(name, track=True)
+    writer = RingWriter(ring)
+    sample = new_sample()
+
+    try:
+        ser = serial.Serial(port, baudrate, timeout=RING_POLL_INTERVAL)
+        if capture is not None:
+            ser = CaptureSerial(ser, capture)
+    except (serial.SerialException, OSError) as se:
+        print(se.args)
+        ring.close()
+        sys.exit(ACQUIRE_PORT_ERROR)
+
+    reader = PacketReader(ser)
+
+    while not stop_event.is_set():
+        packet = reader.read()
+        ring.counters[DISCARDED] = reader.discarded
+        if packet is None:
+            continue
+        decode_packet(packet, sample, ring.offsets)
+        writer.write(sample, 1)
+
+    ser.close()
+    ring.close()
@@ -0,0 +1,181 @@
+""" Layout and decoding of IMU samples
+
+A sample is an ``array('d')`` of CHANNEL_COUNT values indexed by the
+channel constants below. A batch is a single ``array('d')`` holding
+several samples back to back, so it can be handed between the decoder,
+the recorder and network or analysis consumers without any per-sample
+objects.
+"""
+import struct
+import operator
+
+from array import array
+
+CHANNELS = (
+    'accel_x', 'accel_y', 'accel_z', 'accel_t',
+    'vel_x', 'vel_y', 'vel_z', 'vel_t',
+    'angle_x', 'angle_y', 'angle_z', 'angle_t'
+)
+CHANNEL_COUNT = len(CHANNELS)
+
+(ACCEL_X, ACCEL_Y, ACCEL_Z, ACCEL_T,
+ VEL_X, VEL_Y, VEL_Z, VEL_T,
+ ANGLE_X, ANGLE_Y, ANGLE_Z, ANGLE_T) = range(CHANNEL_COUNT)
+
+CSV_FIELDS = sorted(CHANNELS)
+csv_row = operator.itemgetter(*[CHANNELS.index(f) for f in CSV_FIELDS])
+
+PACKET_HEADER = 0x55
+PACKET_HEADER_BYTE = bytes((PACKET_HEADER,))
+PACKET_LENGTH = 33
+FRAME = struct.Struct('<BBhhhhx')
+
+ACCEL_PREFIX = 0x51
+VEL_PREFIX = 0x52
+ANGLE_PREFIX = 0x53
+
+# prefix: (first channel, scale of x/y/z)
+FRAME_CHANNELS = {
+    ACCEL_PREFIX: (ACCEL_X, 16 / 32768),
+    VEL_PREFIX: (VEL_X, 2000 / 32768),
+    ANGLE_PREFIX: (ANGLE_X, 180 / 32768)
+}
+
+
+def new_sample():
+    """
+
+    :return:
+    """
+    return array('d', bytes(8 * CHANNEL_COUNT))
+
+
+def new_batch(size):
+    """
+
+    :param size:
+        Number of samples
+    :return:
+    """
+    return array('d', bytes(8 * CHANNEL_COUNT * size))
+
+
+ZERO_OFFSETS = new_sample()
+
+
+def decode_packet(data, sample, offsets=ZERO_OFFSETS, position=0):
+    """ Decodes the accel, velocity and angle frames of one packet
+
+    :param data:
+        A bytes-like object with the packet starting at position
+    :param sample:
+        Sample updated in place, channels of missing frames keep their
+        previous values
+    :param offsets:
+        A sample of calibration offsets subtracted from the x/y/z values
+    :param position:
+    :returns:
+        The number of frames that were not recognised
+    """
+    errors = 0
+
+    for start in range(position, position + PACKET_LENGTH, FRAME.size):
+        header, prefix, x, y, z, t = FRAME.unpack_from(data, start)
+        channels = FRAME_CHANNELS.get(prefix)
+
+        if header != PACKET_HEADER or channels is None:
+            errors += 1
+            continue
+
+        channel, scale = channels
+        sample[channel] = x * scale - offsets[channel]
+        sample[channel + 1] = y * scale - offsets[channel + 1]
+        sample[channel + 2] = z * scale - offsets[channel + 2]
+        sample[channel + 3] = t / 340 + 36.25
+
+    return errors
+
+
+class PacketReader:
+    """ Reads packets aligned on the packet header from a port with a
+    timeout
+
+    The bytes of a packet cut by the timeout are kept for the next read,
+    so the timeout may be shorter than a packet at any baudrate.
+    """
+    def __init__(self, ser):
+        """
+
+        :param ser:
+            An open serial.Serial
+        """
+        self.ser = ser
+        self.buffer = bytearray()
+        self.discarded = 0
+
+    def read(self):
+        """
+
+        :returns:
+            The packet or None if the port timed out
+        """
+        buffer = self.buffer
+
+        while True:
+            start = buffer.find(PACKET_HEADER_BYTE)
+            if start < 0:
+                start = len(buffer)
+            if start:
+                # a run of bytes outside any packet
+                del buffer[:start]
+                self.discarded += 1
+
+            if len(buffer) >= PACKET_LENGTH:
+                packet = bytes(buffer[:PACKET_LENGTH])
+                del buffer[:PACKET_LENGTH]
+                return packet
+
+            data = self.ser.read(
+                max(PACKET_LENGTH - len(buffer), self.ser.in_waiting)
+            )
+            if not data:
+                return None
+            buffer += data
+
+
+def count_frames(data):
+    """ Counts the valid frames in a raw byte stream
+
+    A frame is valid when it starts with the header, has a known prefix
+    and its last byte is the checksum of the other ten.
+
+    :param data:
+        A bytes object
+    :returns:
+        The number of valid frames
+    """
+    frames = 0
+    start = data.find(PACKET_HEADER_BYTE)
+
+    while 0 <= start <= len(data) - FRAME.size:
+        end = start + FRAME.size
+        if data[start + 1] in FRAME_CHANNELS and \
+                sum(data[start:end - 1]) & 0xFF == data[end - 1]:
+            frames += 1
+            start = data.find(PACKET_HEADER_BYTE, end)
+        else:
+            start = data.find(PACKET_HEADER_BYTE, start + 1)
+
+    return frames
+
+
+def iter_rows(batch, count):
+    """ Yields the samples of a batch in CSV_FIELDS order
+
+    :param batch:
+    :param count:
+        Number of samples in the batch
+    """
+    view = memoryview(batch)
+    for offset in range(0, count * CHANNEL_COUNT, CHANNEL_COUNT):
+        yield csv_row(view[offset:offset + CHANNEL_COUNT])
@@ -0,0 +1,188 @@
+""" Rolling Welch power spectral density of IMU channels
+
+Samples are kept in a NumPy ring buffer. A new windowed segment is
+transformed every ``hop`` samples and the PSD is the mean of the last
+``averages`` segment periodograms, so each sample is transformed only
+window / hop times no matter how often the spectrum is read.
+"""
+import sys
+import time
+
+import numpy as np
+
+SPECTRUM_RATE = 100
+SPECTRUM_WINDOW = 256
+SPECTRUM_OVERLAP = 0.5
+SPECTRUM_AVERAGES = 8
+SPECTRUM_BANDS = ((1, 5), (5, 20), (20, 50))
+
+BENCHMARK_SECONDS = 600
+BENCHMARK_BATCH = 10
+
+
+class SpectrumAnalyzer:
+    def __init__(self, channel_count, sample_rate=SPECTRUM_RATE,
+                 window=SPECTRUM_WINDOW, overlap=SPECTRUM_OVERLAP,
+                 averages=SPECTRUM_AVERAGES, bands=SPECTRUM_BANDS):
+        """
+
+        :param channel_count:
+        :param sample_rate:
+            Sensor output rate in Hz
+        :param window:
+            Segment length in samples
+        :param overlap:
+            Fraction of a segment shared with the previous one
+        :param averages:
+            Number of segments averaged
+        :param bands:
+            (low, high) frequency bands in Hz for band RMS
+        """
+        self.window = window
+        self.hop = max(1, int(round(window * (1 - overlap))))
+        self.averages = averages
+        self.bands = bands
+
+        # every sample is stored twice so the last window is contiguous
+        self.buffer = np.zeros((2 * window, channel_count))
+        self.position = 0
+        self.pending = 0
+        self.total = 0
+
+        self.taper = np.hanning(window)[:, np.newaxis]
+        self.freqs = np.fft.rfftfreq(window, 1 / sample_rate)
+        self.resolution = self.freqs[1]
+
+        scale = np.full((len(self.freqs), 1), 2.0)
+        scale[0] = 1.0
+        if window % 2 == 0:
+            scale[-1] = 1.0
+        self.scale = scale / (sample_rate * np.sum(self.taper ** 2))
+
+        self.band_masks = [
+            (self.freqs >= low) & (self.freqs < high) for low, high in bands
+        ]
+
+        self.periodograms = np.zeros(
+            (averages, len(self.freqs), channel_count)
+        )
+        self.segments = 0
+
+    def feed(self, samples):
+        """
+
+        :param samples:
+            An array of shape (count, channel_count)
+        :returns:
+            The number of new segments transformed
+        """
+        window = self.window
+        new_segments = 0
+        start = 0
+
+        while start < len(samples):
+            take = min(
+                len(samples) - start,
+                self.hop - self.pending,
+                window - self.position
+            )
+            chunk = samples[start:start + take]
+            end = self.position + take
+
+            self.buffer[self.position:end] = chunk
+            self.buffer[self.position + window:end + window] = chunk
+
+            self.position = end % window
+            self.pending += take
+            self.total += take
+            start += take
+
+            if self.pending == self.hop:
+                self.pending = 0
+                if self.total >= window:
+                    self.add_segment()
+                    new_segments += 1
+
+        return new_segments
+
+    def add_segment(self):
+        """
+
+        """
+        segment = self.buffer[self.position:self.position + self.window]
+        segment = (segment - segment.mean(axis=0)) * self.taper
+
+        spectrum = np.fft.rfft(segment, axis=0)
+        self.periodograms[self.segments % self.averages] = (
+            (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        )
+        self.segments += 1
+
+    def psd(self):
+        """
+
+        :returns:
+            An array of shape (len(freqs), channel_count) in units^2/Hz
+        """
+        count = min(self.segments, self.averages)
+        if not count:
+            return np.zeros(self.periodograms.shape[1:])
+        return self.periodograms[:count].mean(axis=0)
+
+    def dominant(self, psd):
+        """
+
+        :param psd:
+        :returns:
+            Frequencies and PSD values of the highest peak per channel,
+            ignoring the DC bin
+        """
+        index = np.argmax(psd[1:], axis=0) + 1
+        return self.freqs[index], psd[index, np.arange(psd.shape[1])]
+
+    def band_rms(self, psd):
+        """
+
+        :param psd:
+        :returns:
+            An array of shape (len(bands), channel_count)
+        """
+        return np.array([
+            np.sqrt(psd[mask].sum(axis=0) * self.resolution)
+            for mask in self.band_masks
+        ])
+
+
+def benchmark(seconds=BENCHMARK_SECONDS, sample_rate=SPECTRUM_RATE,
+              window=SPECTRUM_WINDOW, overlap=SPECTRUM_OVERLAP):
+    """ Measures how many samples per second the analyzer can take
+
+    :param seconds:
+        Length of the simulated recording
+    :param sample_rate:
+    :param window:
+    :param overlap:
+    """
+    analyzer = SpectrumAnalyzer(6, sample_rate, window, overlap)
+    t = np.arange(seconds * sample_rate) / sample_rate
+    samples = np.random.randn(len(t), 6) * 0.01
+    samples[:, 0] += np.sin(2 * np.pi * 12.5 * t)
+
+    start = time.perf_counter()
+    for offset in range(0, len(samples), BENCHMARK_BATCH):
+        if analyzer.feed(samples[offset:offset + BENCHMARK_BATCH]):
+            psd = analyzer.psd()
+            analyzer.dominant(psd)
+            analyzer.band_rms(psd)
+    elapsed = time.perf_counter() - start
+
+    print('{} samples, window {}, hop {}: {:.0f} samples/s, '
+          '{:.0f}x real time at {} Hz, peak at {:.2f} Hz'.format(
+              len(samples), window, analyzer.hop,
+              len(samples) / elapsed, seconds / elapsed, sample_rate,
+              analyzer.dominant(analyzer.psd())[0][0]
+          ))
+
+
+if __name__ == '__main__':
+    benchmark(*[int(arg) for arg in sys.argv[1:4]])
@@ -0,0 +1,319 @@
+""" Network streaming of decoded IMU samples
+
+Every published batch of samples is sent over TCP as one frame: a fixed
+header followed by the samples as little-endian float32 values in
+CHANNELS order::
+
+    magic (2 bytes) | count (uint16) | seq (uint32) | time (float64)
+    count * CHANNEL_COUNT * float32
+
+``seq`` is the number of the first sample in the frame, so a client can
+tell exactly how many samples it has missed. Every client gets its own
+bounded queue and sender thread: when a client is too slow its frames are
+dropped instead of stalling the acquisition thread.
+"""
+import sys
+import time
+import queue
+import socket
+import struct
+import threading
+
+from array import array
+
+from imu_sample import CHANNEL_COUNT, new_batch
+
+STREAM_HOST = ''
+STREAM_PORT = 5555
+QUEUE_SIZE = 100
+
+BENCHMARK_SUBSCRIBERS = (1, 2, 5, 10, 20, 50)
+BENCHMARK_SAMPLES = 200000
+BENCHMARK_BATCH = 10
+
+FRAME_MAGIC = b'MP'
+FRAME_HEADER = struct.Struct('<2sHId')
+SAMPLE_SIZE = 4 * CHANNEL_COUNT
+
+
+class StreamServer:
+    def __init__(self, host=STREAM_HOST, port=STREAM_PORT,
+                 queue_size=QUEUE_SIZE):
+        """
+
+        :param host:
+            Address to listen on, empty string for all interfaces
+        :param port:
+            TCP port, 0 picks a free one
+        :param queue_size:
+            Number of frames buffered per client before dropping
+        """
+        self.queue_size = queue_size
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.address = self.sock.getsockname()
+
+        self.clients = []
+        self.lock = threading.Lock()
+        self.running = True
+
+        self.seq = 0
+
+        threading.Thread(target=self.accept_clients, daemon=True).start()
+
+    def accept_clients(self):
+        """
+
+        """
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = StreamClientHandler(conn, self.queue_size)
+            with self.lock:
+                self.clients.append(client)
+
+    def publish(self, batch, count):
+        """ Sends a batch of samples to all clients
+
+        :param batch:
+            An array('d') with the samples back to back
+        :param count:
+            Number of samples to send from the batch
+        """
+        if not count:
+            return
+
+        values = array('f', batch[:count * CHANNEL_COUNT])
+        if sys.byteorder != 'little':
+            values.byteswap()
+
+        frame = FRAME_HEADER.pack(
+            FRAME_MAGIC, count, self.seq & 0xFFFFFFFF, time.time()
+        ) + values.tobytes()
+        self.seq += count
+
+        with self.lock:
+            self.clients = [c for c in self.clients if c.alive]
+            clients = list(self.clients)
+
+        for client in clients:
+            client.put(frame)
+
+    def close(self):
+        """
+
+        """
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+        with self.lock:
+            clients, self.clients = self.clients, []
+
+        for client in clients:
+            client.close()
+
+
+class StreamClientHandler:
+    def __init__(self, conn, queue_size):
+        """
+
+        :param conn:
+        :param queue_size:
+        """
+        self.conn = conn
+        self.frames = queue.Queue(queue_size)
+        self.dropped = 0
+        self.alive = True
+
+        threading.Thread(target=self.send_frames, daemon=True).start()
+
+    def put(self, frame):
+        """
+
+        :param frame:
+        """
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped += 1
+
+    def send_frames(self):
+        """
+
+        """
+        while self.alive:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            try:
+                self.conn.sendall(frame)
+            except OSError:
+                break
+
+        self.alive = False
+        self.conn.close()
+
+    def close(self):
+        """
+
+        """
+        self.alive = False
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            self.conn.close()
+
+
+class StreamClient:
+    """ Receives IMU samples from a StreamServer
+
+        Usage::
+
+            from imu_sample import CHANNEL_COUNT, ANGLE_X
+
+            client = StreamClient('192.168.0.10')
+            for seq, timestamp, samples in client:
+                for i in range(0, len(samples), CHANNEL_COUNT):
+                    print(samples[i + ANGLE_X])
+    """
+    def __init__(self, host='localhost', port=STREAM_PORT, timeout=None):
+        """
+
+        :param host:
+        :param port:
+        :param timeout:
+        """
+        self.sock = socket.create_connection((host, port), timeout)
+        self.next_seq = None
+        self.missed = 0
+
+    def read_exactly(self, size):
+        """
+
+        :param size:
+        :return:
+        """
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+
+        while received < size:
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError('Stream closed')
+            received += n
+
+        return data
+
+    def read_frame(self):
+        """ Reads one frame
+
+        :raises ConnectionError:
+            When the server closes the connection
+        :returns:
+            A (seq, timestamp, samples) tuple where samples is an
+            array('f') with the samples back to back in CHANNELS order
+        """
+        magic, count, seq, timestamp = FRAME_HEADER.unpack(
+            self.read_exactly(FRAME_HEADER.size)
+        )
+        if magic != FRAME_MAGIC:
+            raise ConnectionError('Bad frame header')
+
+        samples = array('f', self.read_exactly(count * SAMPLE_SIZE))
+        if sys.byteorder != 'little':
+            samples.byteswap()
+
+        if self.next_seq is not None:
+            self.missed += (seq - self.next_seq) & 0xFFFFFFFF
+        self.next_seq = (seq + count) & 0xFFFFFFFF
+
+        return seq, timestamp, samples
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.read_frame()
+        except ConnectionError:
+            return
+
+    def close(self):
+        """
+
+        """
+        self.sock.close()
+
+
+def benchmark(subscribers=BENCHMARK_SUBSCRIBERS,
+              sample_count=BENCHMARK_SAMPLES, batch_size=BENCHMARK_BATCH):
+    """ Measures fan-out throughput to local subscribers
+
+    :param subscribers:
+        Numbers of simultaneous subscribers to test
+    :param sample_count:
+        Number of samples published in each run
+    :param batch_size:
+        Number of samples per published batch
+    """
+    batch = new_batch(batch_size)
+
+    print('{:>8} {:>14} {:>16} {:>10}'.format(
+        'clients', 'publish (S/s)', 'delivered (S/s)', 'missed (%)'
+    ))
+
+    for n in subscribers:
+        server = StreamServer('localhost', 0)
+        clients = [StreamClient(*server.address) for _ in range(n)]
+        received = [0] * n
+
+        def consume(index, client):
+            for _, _, samples in client:
+                received[index] += len(samples) // CHANNEL_COUNT
+
+        threads = [
+            threading.Thread(target=consume, args=(i, c), daemon=True)
+            for i, c in enumerate(clients)
+        ]
+        for thread in threads:
+            thread.start()
+
+        while len(server.clients) < n:
+            time.sleep(0.01)
+
+        start = time.perf_counter()
+        for _ in range(sample_count // batch_size):
+            server.publish(batch, batch_size)
+        server.publish(batch, sample_count % batch_size)
+        publish_time = time.perf_counter() - start
+
+        server.close()
+        for thread in threads:
+            thread.join()
+        total_time = time.perf_counter() - start
+
+        missed = n * sample_count - sum(received)
+        print('{:>8} {:>14.0f} {:>16.0f} {:>10.2f}'.format(
+            n,
+            sample_count / publish_time,
+            sum(received) / total_time,
+            missed / (n * sample_count) * 100
+        ))
+
+        for client in clients:
+            client.close()
+
+
+if __name__ == '__main__':
+    benchmark(tuple(int(arg) for arg in sys.argv[1:]) or
+              BENCHMARK_SUBSCRIBERS)
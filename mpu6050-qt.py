@@ -3,15 +3,19 @@ import sys
 import csv
 import time
 import glob
+import queue
 import os.path
 import itertools
+import threading
+import collections
+import multiprocessing
 
 import PyQt5
 import serial
 
 from PyQt5 import QtCore
 from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QIntValidator
+from PyQt5.QtGui import QIntValidator, QDoubleValidator
 
 from PyQt5.QtWidgets import (
     QLCDNumber,
@@ -29,21 +33,99 @@ from PyQt5.QtWidgets import (
     QDialog
 )
 
-from bitstring import BitArray
+from imu_sample import (
+    ACCEL_X,
+    ACCEL_Y,
+    ACCEL_Z,
+    VEL_X,
+    VEL_Y,
+    VEL_Z,
+    ANGLE_X,
+    ANGLE_Y,
+    ANGLE_Z,
+    CHANNELS,
+    CHANNEL_COUNT,
+    CSV_FIELDS,
+    FRAME,
+    PacketReader,
+    decode_packet,
+    iter_rows,
+    new_batch,
+    count_frames,
+    new_sample
+)
+from imu_stream import STREAM_PORT, StreamServer
+from imu_control import CONTROL_PORT, DEFAULT_WAIT, ControlServer
+from imu_ring import DISCARDED, RING_NAME, RingReader, SampleRing, acquire
+from imu_capture import (
+    CAPTURE_EXT,
+    IMU_CAPTURE,
+    PLATFORM_CAPTURE,
+    CaptureSerial,
+    capture_path
+)
+from imu_calibration import (
+    Calibrator,
+    load_profile,
+    profile_offsets,
+    save_profile
+)
+from platform_protocol import (
+    RESPONSE_TIMEOUT,
+    ErrorReply,
+    Move,
+    MoveDone,
+    PlatformProtocol,
+    Position,
+    PositionReply,
+    Zero,
+    ZeroDone
+)
+
+SPECTRUM_CHANNELS = (
+    (ACCEL_X, 'Ускор. X'),
+    (ACCEL_Y, 'Ускор. Y'),
+    (ACCEL_Z, 'Ускор. Z'),
+    (VEL_X, 'Скор. X'),
+    (VEL_Y, 'Скор. Y'),
+    (VEL_Z, 'Скор. Z')
+)
 
-PACKET_LENGTH = 32
+BATCH_SIZE = 10
 LCD_DIGIT_COUNT = 6
 DELAY_CNT = 15
-
-MOVE_DONE = b'M'
-ZERO_ALL = b'X'
-
-PACKET_HEADER = '0x55'
-ACCEL_PREFIX = '0x51'
-VEL_PREFIX = '0x52'
-ANGLE_PREFIX = '0x53'
+RING_TIMEOUT = 0.1
+SERIAL_TIMEOUT = 0.1
+PROCESS_TIMEOUT = 1
+
+SPECTRUM_QUEUE_SIZE = 1000
+SPECTRUM_INTERVAL = 0.2
+SPECTRUM_WINDOWS = ('64', '128', '256', '512', '1024', '2048', '4096')
+SPECTRUM_OVERLAPS = ('0', '25', '50', '75')
+SPECTRUM_RATE = '100'
+SPECTRUM_WINDOW = '256'
+SPECTRUM_OVERLAP = '50'
+
+POSITION_TOLERANCE = '0.1'
+STEPS_PER_DEGREE = '100'
+MAX_ITERATIONS = 20
+MAX_CORRECTION = 5000
+SETTLE_SAMPLES = 10
+SETTLE_SPAN = 0.05
+SETTLE_TIMEOUT = 5
+SAMPLE_TIMEOUT = 1
+MOVE_TIMEOUT = 30
+MOVE_POLL_INTERVAL = 0.1
+
+DETECT_WINDOW = 0.12
+DETECT_MAX_WINDOW = 0.25
+DETECT_POLL = 0.01
+DETECT_RATE_PACKETS = 3
+# the usual rate of these sensors besides IMU_BAUD
+DETECT_SECOND = 9600
 
 DEFAULT_PORT = 'COM14'
+AUTO_BAUD = 'Авто'
 IMU_BAUD = '115200'
 PLATFORM_BAUD = '9600'
 BAUDRATES = (
@@ -168,6 +250,73 @@ def get_ports():
     return result
 
 
+def detect_baudrate(port, first=IMU_BAUD):
+    """ Finds the baudrate the IMU is sending at
+
+    Every candidate rate is listened to until the first frame with a valid
+    checksum arrives, at most about one packet period of a 10 Hz sensor.
+    Noise at a wrong rate practically never passes the checksum, so the
+    first rate with a valid frame is taken. Listening goes on for up to
+    DETECT_RATE_PACKETS more packets and the packet rate is estimated from
+    the times the frames arrived at. A window without a single byte means
+    nothing is sending at all and ends the search.
+
+    :param port:
+    :param first:
+        The rate to try first, DETECT_SECOND is tried next
+    :raises serial.SerialException:
+        When the port can't be opened
+    :returns:
+        A (baudrate, packets per second) tuple or None if no rate syncs,
+        the packet rate is None if only one packet arrived
+    """
+    candidates = sorted(
+        (int(rate) for rate in BAUDRATES),
+        key=lambda rate: (rate != int(first), rate != DETECT_SECOND, -rate)
+    )
+
+    with serial.Serial(port, candidates[0], timeout=DETECT_POLL) as ser:
+        for rate in candidates:
+            ser.baudrate = rate
+            ser.reset_input_buffer()
+
+            window = min(
+                DETECT_WINDOW + FRAME.size * 10 / rate, DETECT_MAX_WINDOW
+            )
+            deadline = time.perf_counter() + window
+            data = b''
+            first_frames = packets = 0
+            first_time = last_time = None
+
+            while time.perf_counter() < deadline:
+                data += ser.read(max(1, ser.in_waiting))
+                frames = count_frames(data)
+
+                if first_time is None:
+                    if frames:
+                        # listen for the next packets, one window at most
+                        first_frames = frames
+                        first_time = time.perf_counter()
+                        deadline = first_time + window
+                elif (frames - first_frames) // 3 > packets:
+                    # the same frame of a later packet
+                    packets = (frames - first_frames) // 3
+                    last_time = time.perf_counter()
+                    if packets >= DETECT_RATE_PACKETS:
+                        break
+
+            if first_time is None:
+                if not data:
+                    return None
+                continue
+
+            if not packets:
+                return rate, None
+            return rate, packets / (last_time - first_time)
+
+    return None
+
+
 # noinspection PyArgumentList
 class ImuSignal(QtCore.QObject):
     angle_x = QtCore.pyqtSignal(str)
@@ -182,10 +331,38 @@ class ImuSignal(QtCore.QObject):
     vel_y = QtCore.pyqtSignal(str)
     vel_z = QtCore.pyqtSignal(str)
 
+    calibrated = QtCore.pyqtSignal(object)
+    disconnected = QtCore.pyqtSignal(str)
+
 
 # noinspection PyArgumentList
 class PlatformSignal(QtCore.QObject):
     move_done = QtCore.pyqtSignal(bool)
+    zero_done = QtCore.pyqtSignal(bool)
+    position = QtCore.pyqtSignal(object)
+    disconnected = QtCore.pyqtSignal(str)
+
+
+# noinspection PyArgumentList
+class PositioningSignal(QtCore.QObject):
+    status = QtCore.pyqtSignal(str)
+    position = QtCore.pyqtSignal(int, int)
+    done = QtCore.pyqtSignal(bool)
+
+
+# noinspection PyArgumentList
+class ControlSignal(QtCore.QObject):
+    command = QtCore.pyqtSignal(object)
+
+
+# noinspection PyArgumentList
+class SpectrumSignal(QtCore.QObject):
+    result = QtCore.pyqtSignal(object)
+
+
+# noinspection PyArgumentList
+class DetectSignal(QtCore.QObject):
+    detected = QtCore.pyqtSignal(object)
 
 
 class ImuReadThread(QtCore.QThread):
@@ -194,96 +371,259 @@ class ImuReadThread(QtCore.QThread):
 
         self.signal = ImuSignal()
 
-        self.imu_data = {
-            'accel_x': 0.0, 'accel_y': 0.0, 'accel_z': 0.0, 'accel_t': 0.0,
-            'vel_x': 0.0, 'vel_y': 0.0, 'vel_z': 0.0, 'vel_t': 0.0,
-            'angle_x': 0.0, 'angle_y': 0.0, 'angle_z': 0.0, 'angle_t': 0.0
-        }
+        self.sample = new_sample()
+        self.batch = new_batch(BATCH_SIZE)
+        self.batch_count = 0
+        self.frame_errors = 0
+        self.delay_cnt = DELAY_CNT
+
+        self.offsets = new_sample()
+        self.calibrator = None
 
         self.start_angle_x = 0
         self.start_angle_y = 0
         self.start_angle_z = 0
 
         self.record_state = False
+        self.record_lock = threading.Lock()
+        self.fname = None
+
+        self.spectrum_queue = None
+        self.spectrum_dropped = 0
+
+        self.last_angle = None
+        self.new_angle = threading.Event()
+
+        self.stream_server = None
+
+        self.packet_reader = None
+        self.stop_requested = False
 
-    def open_port(self, port, baudrate):
+        self.process = None
+        self.stop_event = None
+        self.ring = None
+        self.ring_reader = None
+
+    def open_port(self, port, baudrate, capture=None):
+        """
+
+        :param port:
+        :param baudrate:
+        :param capture:
+            File to record the raw port data to
         """
+        self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT)
+        if capture is not None:
+            self.ser = CaptureSerial(self.ser, capture)
+        self.packet_reader = PacketReader(self.ser)
+        self.stop_requested = False
+
+    def open_process(self, port, baudrate, capture=None):
+        """ Starts reading the port in a separate process
+
+        The process decodes samples into a shared memory ring which this
+        thread reads instead of the port.
 
         :param port:
         :param baudrate:
+        :param capture:
+            File to record the raw port data to
+        """
+        self.ring = SampleRing.create()
+        self.ring_reader = RingReader(self.ring)
+        if self.ring.name != RING_NAME:
+            print('Sample ring: {}'.format(self.ring.name))
+
+        # the process applies whatever offsets are in the ring
+        self.ring.offsets[:] = self.offsets
+        self.offsets = self.ring.offsets
+        self.stop_event = multiprocessing.Event()
+
+        self.process = multiprocessing.Process(
+            target=acquire,
+            args=(port, baudrate, self.ring.name, self.stop_event, capture),
+            daemon=True
+        )
+        self.process.start()
+
+    def stop(self):
         """
-        self.ser = serial.Serial(port, baudrate)
+
+        """
+        if self.process is None:
+            self.stop_requested = True
+            self.wait()
+            return
+
+        self.stop_event.set()
+        self.process.join(PROCESS_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.wait()
+
+    def close_port(self):
+        """
+
+        """
+        if self.process is None:
+            try:
+                self.ser.flush()
+            except (serial.SerialException, OSError):
+                # the port is gone, there is nothing left to send
+                pass
+            try:
+                self.ser.close()
+            except (serial.SerialException, OSError) as se:
+                print(se.args)
+            return
+
+        print('Missed {} samples, discarded {} packets.'.format(
+            self.ring_reader.missed, self.ring.counters[DISCARDED]
+        ))
+
+        self.ring_reader = None
+        self.offsets = new_sample()
+        memoryview(self.offsets)[:] = self.ring.offsets
+        self.ring.close()
+        self.ring.unlink()
+        self.ring = None
+        self.process = None
 
     def create_file(self, path):
         """
 
         :param path:
+        :return:
         """
         ext = '.csv'
         fname = os.path.join(
             path,
             time.strftime('%Y%m%d%H%M%S') + ext
         )
-        self.fobject = open(fname, 'w', newline='')
+        fobject = open(fname, 'w', newline='')
 
-        fieldnames = sorted(self.imu_data.keys())
-        self.file_writer = csv.DictWriter(self.fobject, fieldnames=fieldnames)
-        self.file_writer.writeheader()
+        file_writer = csv.writer(fobject)
+        file_writer.writerow(CSV_FIELDS)
 
-        self.record_state = True
+        with self.record_lock:
+            self.fobject = fobject
+            self.file_writer = file_writer
+            self.fname = fname
+            self.record_state = True
 
-    def read_ser_data(self):
+        return fname
+
+    def stop_recording(self):
         """
 
-        :return:
         """
-        ser_data = BitArray()
+        with self.record_lock:
+            if not self.record_state:
+                return
+            self.file_writer.writerows(
+                iter_rows(self.batch, self.batch_count)
+            )
+            self.record_state = False
 
-        while True:
-            packet_header = BitArray(self.ser.read())
-            if packet_header == PACKET_HEADER:
-                ser_data += packet_header
-                break
+        self.fobject.flush()
+        self.fobject.close()
+
+    def start_stream(self):
+        """
+
+        """
+        self.stream_server = StreamServer()
+
+    def stop_stream(self):
+        """
+
+        """
+        if self.stream_server is not None:
+            self.stream_server.close()
+            self.stream_server = None
 
-        ser_data += BitArray(self.ser.read(PACKET_LENGTH))
-        return ser_data
+    def read_ser_data(self):
+        """
+
+        :return:
+        """
+        return self.packet_reader.read()
 
     def decode_imu_data(self, ser_data):
         """
 
         :param ser_data:
         """
-        chunks = ser_data.unpack('bytes:11, bytes:11, bytes:11')
+        self.frame_errors += decode_packet(
+            ser_data, self.sample, self.offsets
+        )
 
-        for chunk in chunks:
-            _, prefix, *bs = BitArray(chunk).unpack(
-                'bytes:1, bytes:1, intle:16, intle:16, intle:16, intle:16'
-            )
-            if BitArray(prefix) == ACCEL_PREFIX:
-                self.imu_data['accel_x'] = bs[0] / 32768 * 16
-                self.imu_data['accel_y'] = bs[1] / 32768 * 16
-                self.imu_data['accel_z'] = bs[2] / 32768 * 16
-                self.imu_data['accel_t'] = bs[3] / 340 + 36.25
-            elif BitArray(prefix) == VEL_PREFIX:
-                self.imu_data['vel_x'] = bs[0] / 32768 * 2000
-                self.imu_data['vel_y'] = bs[1] / 32768 * 2000
-                self.imu_data['vel_z'] = bs[2] / 32768 * 2000
-                self.imu_data['vel_t'] = bs[3] / 340 + 36.25
-            elif BitArray(prefix) == ANGLE_PREFIX:
-                self.imu_data['angle_x'] = bs[0] / 32768 * 180
-                self.imu_data['angle_y'] = bs[1] / 32768 * 180
-                self.imu_data['angle_z'] = bs[2] / 32768 * 180
-                self.imu_data['angle_t'] = bs[3] / 340 + 36.25
-            else:
-                pass  # TODO: error handling here
+    def set_offsets(self, offsets):
+        """
+
+        :param offsets:
+            A sample of offsets subtracted by the decoder
+        """
+        self.offsets[:] = offsets
+
+    def start_calibration(self):
+        """ Starts collecting a stationary window of samples
+
+        The result is emitted by signal.calibrated.
+        """
+        self.calibrator = Calibrator(self.offsets)
+
+    def store_sample(self):
+        """ Appends the current sample to the batch
+
+        """
+        offset = self.batch_count * CHANNEL_COUNT
+        self.batch[offset:offset + CHANNEL_COUNT] = self.sample
+        self.batch_count += 1
+
+        if self.batch_count == BATCH_SIZE:
+            self.flush_batch()
+
+    def flush_batch(self):
+        """
+
+        """
+        with self.record_lock:
+            self.write_batch(self.batch, self.batch_count)
+            self.batch_count = 0
+
+    def write_batch(self, batch, count):
+        """ Hands a batch over to the recorder and the stream
+
+        Must be called with record_lock held.
+
+        :param batch:
+        :param count:
+        """
+        if self.record_state:
+            self.file_writer.writerows(iter_rows(batch, count))
+
+        if self.calibrator is not None and \
+                self.calibrator.update(batch, count):
+            self.signal.calibrated.emit(self.calibrator.profile())
+            self.calibrator = None
+
+        if self.stream_server is not None:
+            self.stream_server.publish(batch, count)
+
+        if self.spectrum_queue is not None:
+            try:
+                self.spectrum_queue.put_nowait(batch[:count * CHANNEL_COUNT])
+            except queue.Full:
+                self.spectrum_dropped += count
 
     def set_relative_angle(self):
         """
 
         """
-        self.start_angle_x = self.imu_data['angle_x']
-        self.start_angle_y = self.imu_data['angle_y']
-        self.start_angle_z = self.imu_data['angle_z']
+        self.start_angle_x = self.sample[ANGLE_X]
+        self.start_angle_y = self.sample[ANGLE_Y]
+        self.start_angle_z = self.sample[ANGLE_Z]
 
     def set_absolute_angle(self):
         """
@@ -293,128 +633,746 @@ class ImuReadThread(QtCore.QThread):
         self.start_angle_y = 0
         self.start_angle_z = 0
 
-    def run(self):
+    def wait_angle(self, timeout):
+        """ Waits for the next decoded sample
+
+        :param timeout:
+            Maximum time to wait in seconds
+        :returns:
+            A (timestamp, angle_x, angle_y) tuple with the angles relative
+            to the current start angle or None on timeout
         """
+        self.new_angle.clear()
+        if not self.new_angle.wait(timeout):
+            return None
+        return self.last_angle
 
+    def update_angle(self):
         """
-        delay_cnt = DELAY_CNT
 
-        while True:
-            self.decode_imu_data(self.read_ser_data())
+        """
+        self.last_angle = (
+            time.perf_counter(),
+            self.sample[ANGLE_X] - self.start_angle_x,
+            self.sample[ANGLE_Y] - self.start_angle_y
+        )
+        self.new_angle.set()
 
-            if self.record_state:
-                self.file_writer.writerow(self.imu_data)
+    def update_display(self, count):
+        """
 
-            if delay_cnt:
-                delay_cnt -= 1
-            else:
-                delay_cnt = DELAY_CNT
+        :param count:
+            Number of samples since the last call
+        """
+        self.delay_cnt -= count
+        if self.delay_cnt < 0:
+            self.delay_cnt = DELAY_CNT
 
-                self.signal.angle_x.emit(
-                    '{:=6.1f}'.format(
-                        self.imu_data['angle_x'] - self.start_angle_x
-                    )
+            self.signal.angle_x.emit(
+                '{:=6.1f}'.format(
+                    self.sample[ANGLE_X] - self.start_angle_x
                 )
-                self.signal.angle_y.emit(
-                    '{:=6.1f}'.format(
-                        self.imu_data['angle_y'] - self.start_angle_y
-                    )
-                )
-                self.signal.angle_z.emit(
-                    '{:=6.1f}'.format(
-                        self.imu_data['angle_z'] - self.start_angle_z
-                    )
-                )
-                self.signal.accel_x.emit(
-                    '{:=6.2f}'.format(self.imu_data['accel_x'])
-                )
-                self.signal.accel_y.emit(
-                    '{:=6.2f}'.format(self.imu_data['accel_y'])
-                )
-                self.signal.accel_z.emit(
-                    '{:=6.2f}'.format(self.imu_data['accel_z'])
-                )
-                self.signal.vel_x.emit(
-                    '{:=5.0f}'.format(self.imu_data['vel_x'])
+            )
+            self.signal.angle_y.emit(
+                '{:=6.1f}'.format(
+                    self.sample[ANGLE_Y] - self.start_angle_y
                 )
-                self.signal.vel_y.emit(
-                    '{:=5.0f}'.format(self.imu_data['vel_y'])
+            )
+            self.signal.angle_z.emit(
+                '{:=6.1f}'.format(
+                    self.sample[ANGLE_Z] - self.start_angle_z
                 )
-                self.signal.vel_z.emit(
-                    '{:=5.0f}'.format(self.imu_data['vel_z'])
+            )
+            self.signal.accel_x.emit(
+                '{:=6.2f}'.format(self.sample[ACCEL_X])
+            )
+            self.signal.accel_y.emit(
+                '{:=6.2f}'.format(self.sample[ACCEL_Y])
+            )
+            self.signal.accel_z.emit(
+                '{:=6.2f}'.format(self.sample[ACCEL_Z])
+            )
+            self.signal.vel_x.emit(
+                '{:=5.0f}'.format(self.sample[VEL_X])
+            )
+            self.signal.vel_y.emit(
+                '{:=5.0f}'.format(self.sample[VEL_Y])
+            )
+            self.signal.vel_z.emit(
+                '{:=5.0f}'.format(self.sample[VEL_Z])
+            )
+
+    def read_ring(self):
+        """
+
+        """
+        reader = self.ring_reader
+        missed = 0
+
+        while self.process.is_alive():
+            count = reader.wait(RING_TIMEOUT)
+
+            if reader.missed != missed:
+                print('Missed {} samples.'.format(reader.missed - missed))
+                missed = reader.missed
+
+            if not count:
+                continue
+
+            last = (count - 1) * CHANNEL_COUNT
+            self.sample = reader.batch[last:last + CHANNEL_COUNT]
+            self.update_angle()
+
+            with self.record_lock:
+                self.write_batch(reader.batch, count)
+
+            self.update_display(count)
+
+        if not self.stop_event.is_set():
+            self.signal.disconnected.emit(
+                'Acquisition process exited with code {}.'.format(
+                    self.process.exitcode
                 )
+            )
+
+    def run(self):
+        """
+
+        """
+        self.delay_cnt = DELAY_CNT
+
+        if self.process is not None:
+            self.read_ring()
+            return
+
+        while not self.stop_requested:
+            try:
+                packet = self.read_ser_data()
+            except serial.SerialException as se:
+                self.signal.disconnected.emit(str(se))
+                return
+
+            if packet is None:
+                continue
+            self.decode_imu_data(packet)
+            self.update_angle()
+            self.store_sample()
+            self.update_display(1)
+
+
+class PlatformThread(QtCore.QThread):
+    def __init__(self):
+        super().__init__()
+
+        self.signal = PlatformSignal()
+
+        self.protocol = None
+        self.move_request = None
+        self.move_done_event = threading.Event()
+        self.move_done_event.set()
+
+        self.stop_requested = False
+
+    def open_port(self, port, baudrate, capture=None):
+        """
+
+        :param port:
+        :param baudrate:
+        :param capture:
+            File to record the raw port data to
+        """
+        self.ser = serial.Serial(port, baudrate, timeout=SERIAL_TIMEOUT)
+        if capture is not None:
+            self.ser = CaptureSerial(self.ser, capture)
+        self.protocol = PlatformProtocol(self.ser)
+        self.stop_requested = False
+
+    def stop(self):
+        """
+
+        """
+        self.stop_requested = True
+        self.wait()
+
+    def move(self, coords):
+        """
+
+        :param coords:
+            Target positions of the four rods in steps
+        """
+        self.move_done_event.clear()
+        try:
+            self.move_request = self.protocol.send(Move(coords))
+        except serial.SerialException as se:
+            self.signal.disconnected.emit(str(se))
+
+    def zero(self):
+        """
+
+        """
+        try:
+            self.protocol.send(Zero())
+        except serial.SerialException as se:
+            self.signal.disconnected.emit(str(se))
+
+    def query_position(self, timeout):
+        """ Asks the controller for the rod positions, may be called from
+        any thread while the platform is moving
+
+        :param timeout:
+            Time to wait for each attempt in seconds
+        :returns:
+            Positions of the four rods in steps or None
+        """
+        try:
+            response = self.protocol.request(Position(), timeout)
+        except serial.SerialException as se:
+            self.signal.disconnected.emit(str(se))
+            return None
+        if isinstance(response, PositionReply):
+            return response.coords
+        return None
+
+    def run(self):
+        """
+
+        """
+        while not self.stop_requested:
+            try:
+                responses = self.protocol.poll()
+            except serial.SerialException as se:
+                self.signal.disconnected.emit(str(se))
+                return
+
+            for response in responses:
+                if isinstance(response, MoveDone):
+                    self.move_done_event.set()
+                    self.signal.move_done.emit(True)
+                elif isinstance(response, ZeroDone):
+                    self.signal.zero_done.emit(True)
+                elif isinstance(response, PositionReply):
+                    self.signal.position.emit(response.coords)
+                elif isinstance(response, ErrorReply):
+                    print('Platform error {}: {}'.format(
+                        response.code, response.message
+                    ))
+                    if self.move_request is not None and \
+                            self.move_request.response is response:
+                        self.move_done_event.set()
+                        self.signal.move_done.emit(True)
+
+
+class PositioningThread(QtCore.QThread):
+    """ Drives the platform to a target tilt using the IMU as feedback
+
+    Rods 1/2 tilt the platform around X and rods 3/4 around Y, each pair
+    moving in opposite directions as in the synchronous mode. Every
+    iteration waits for the move to finish, reads the settled angle and
+    sends the next correction straight away. The steps per degree gain is
+    re-estimated from the observed response, which absorbs backlash and a
+    wrong sign of the initial guess.
+    """
+    def __init__(self, imu_thread, platform_thread):
+        super().__init__()
+
+        self.signal = PositioningSignal()
+
+        self.imu_thread = imu_thread
+        self.platform_thread = platform_thread
+
+        self.target_x = 0.0
+        self.target_y = 0.0
+        self.tolerance = float(POSITION_TOLERANCE)
+        self.steps_per_degree = float(STEPS_PER_DEGREE)
+        self.position_x = 0
+        self.position_y = 0
+
+        self.stop_requested = False
+
+    def set_target(self, target_x, target_y, tolerance, steps_per_degree,
+                   position_x, position_y):
+        """
+
+        :param target_x:
+            Target tilt around X in degrees
+        :param target_y:
+            Target tilt around Y in degrees
+        :param tolerance:
+            Allowed deviation from the target in degrees
+        :param steps_per_degree:
+            Initial guess of the rod steps per degree of tilt
+        :param position_x:
+            Current position of rod 1 in steps
+        :param position_y:
+            Current position of rod 3 in steps
+        """
+        self.target_x = target_x
+        self.target_y = target_y
+        self.tolerance = tolerance
+        self.steps_per_degree = steps_per_degree
+        self.position_x = position_x
+        self.position_y = position_y
+
+    def read_settled_angle(self):
+        """ Waits until the angle stops changing
+
+        :returns:
+            A (timestamp, angle_x, angle_y) tuple averaged over the last
+            SETTLE_SAMPLES samples or None if the IMU is silent
+        """
+        window = collections.deque(maxlen=SETTLE_SAMPLES)
+        deadline = time.perf_counter() + SETTLE_TIMEOUT
+
+        while not self.stop_requested:
+            sample = self.imu_thread.wait_angle(SAMPLE_TIMEOUT)
+            if sample is None:
+                return None
+
+            window.append(sample)
+            if len(window) < SETTLE_SAMPLES:
+                continue
+
+            xs = [angle_x for _, angle_x, _ in window]
+            ys = [angle_y for _, _, angle_y in window]
+            settled = (
+                max(xs) - min(xs) <= SETTLE_SPAN and
+                max(ys) - min(ys) <= SETTLE_SPAN
+            )
+            if settled or sample[0] > deadline:
+                return sample[0], sum(xs) / len(xs), sum(ys) / len(ys)
+
+        return None
+
+    def wait_move(self):
+        """ Waits for the platform in short slices, so a stop request
+        does not wait for the move
+
+        :returns:
+            True when the move is done, False on timeout or stop
+        """
+        deadline = time.perf_counter() + MOVE_TIMEOUT
+
+        while not self.stop_requested:
+            if self.platform_thread.move_done_event.wait(MOVE_POLL_INTERVAL):
+                return True
+            if time.perf_counter() > deadline:
+                print('Platform did not finish the move.')
+                return False
+
+        return False
+
+    @staticmethod
+    def get_correction(error, gain):
+        """
+
+        :param error:
+        :param gain:
+        :return:
+        """
+        steps = int(round(error * gain))
+        return max(-MAX_CORRECTION, min(MAX_CORRECTION, steps))
+
+    @staticmethod
+    def update_gain(gain, steps, delta):
+        """
+
+        :param gain:
+        :param steps:
+        :param delta:
+        :return:
+        """
+        if steps and abs(delta) > SETTLE_SPAN:
+            return steps / delta
+        return gain
+
+    def run(self):
+        """
+
+        """
+        self.stop_requested = False
+
+        gain_x = gain_y = self.steps_per_degree
+        latencies = []
+        iterations = 0
+        converged = False
+        start_time = time.perf_counter()
+
+        settled = self.read_settled_angle()
+
+        while settled is not None and not self.stop_requested:
+            timestamp, angle_x, angle_y = settled
+            error_x = self.target_x - angle_x
+            error_y = self.target_y - angle_y
+
+            self.signal.status.emit(
+                'dX = {:.2f}, dY = {:.2f}'.format(error_x, error_y)
+            )
+            if abs(error_x) <= self.tolerance and \
+                    abs(error_y) <= self.tolerance:
+                converged = True
+                break
+            if iterations == MAX_ITERATIONS:
+                break
+            iterations += 1
+
+            steps_x = self.get_correction(error_x, gain_x)
+            steps_y = self.get_correction(error_y, gain_y)
+            self.position_x += steps_x
+            self.position_y += steps_y
+
+            self.platform_thread.move((
+                self.position_x, -self.position_x,
+                self.position_y, -self.position_y
+            ))
+            latencies.append(time.perf_counter() - timestamp)
+            self.signal.position.emit(self.position_x, self.position_y)
+
+            if not self.wait_move():
+                break
+
+            settled = self.read_settled_angle()
+            if settled is not None:
+                gain_x = self.update_gain(gain_x, steps_x,
+                                          settled[1] - angle_x)
+                gain_y = self.update_gain(gain_y, steps_y,
+                                          settled[2] - angle_y)
+
+        if settled is None:
+            print('No data from the IMU.')
+
+        if latencies:
+            latency = 'latency avg {:.1f} ms, max {:.1f} ms'.format(
+                sum(latencies) / len(latencies) * 1000,
+                max(latencies) * 1000
+            )
+        else:
+            latency = 'no moves'
+        print(
+            'Target ({:.2f}, {:.2f}): {} after {} iterations '
+            'in {:.1f} s, {}.'.format(
+                self.target_x,
+                self.target_y,
+                'converged' if converged else 'not converged',
+                iterations,
+                time.perf_counter() - start_time,
+                latency
+            )
+        )
+
+        self.signal.done.emit(converged)
+
+
+class SpectrumThread(QtCore.QThread):
+    """ Computes the vibration spectrum of the decoded samples
+
+    ImuReadThread hands copies of its batches over through a bounded
+    queue, so the analysis never slows down the acquisition. While the
+    IMU thread is recording, every new PSD is also written next to the
+    data file.
+    """
+    def __init__(self, imu_thread, analyzer):
+        super().__init__()
+
+        self.signal = SpectrumSignal()
+
+        self.imu_thread = imu_thread
+        self.analyzer = analyzer
+        self.batches = queue.Queue(SPECTRUM_QUEUE_SIZE)
+
+        self.record_fname = None
+        self.fobject = None
+        self.file_writer = None
+
+        self.stop_requested = False
+
+    def open_file(self, fname):
+        """
+
+        :param fname:
+            Name of the data file being recorded
+        """
+        self.fobject = open(
+            os.path.splitext(fname)[0] + '_spectrum.csv', 'w', newline=''
+        )
+        self.file_writer = csv.writer(self.fobject)
+        self.file_writer.writerow(
+            ['time', 'channel'] +
+            ['{:g}'.format(freq) for freq in self.analyzer.freqs]
+        )
+
+    def close_file(self):
+        """
+
+        """
+        if self.fobject is not None:
+            self.fobject.close()
+            self.fobject = None
+            self.file_writer = None
+
+    def record_spectrum(self, psd):
+        """
+
+        :param psd:
+        """
+        fname = self.imu_thread.fname if self.imu_thread.record_state \
+            else None
+
+        if fname != self.record_fname:
+            self.close_file()
+            if fname is not None:
+                self.open_file(fname)
+            self.record_fname = fname
+
+        if self.file_writer is not None:
+            now = time.time()
+            self.file_writer.writerows(
+                [now, CHANNELS[channel]] + psd[:, i].tolist()
+                for i, (channel, _) in enumerate(SPECTRUM_CHANNELS)
+            )
+
+    def run(self):
+        """
+
+        """
+        import numpy as np
+
+        columns = [channel for channel, _ in SPECTRUM_CHANNELS]
+        last_emit = 0
+
+        while not self.stop_requested:
+            try:
+                batch = self.batches.get(timeout=RING_TIMEOUT)
+            except queue.Empty:
+                continue
+
+            samples = np.frombuffer(batch).reshape(-1, CHANNEL_COUNT)
+            if not self.analyzer.feed(samples[:, columns]):
+                continue
+
+            psd = self.analyzer.psd()
+            self.record_spectrum(psd)
+
+            if time.perf_counter() - last_emit > SPECTRUM_INTERVAL:
+                last_emit = time.perf_counter()
+                freqs, peaks = self.analyzer.dominant(psd)
+                self.signal.result.emit((
+                    freqs.tolist(),
+                    peaks.tolist(),
+                    self.analyzer.band_rms(psd).tolist(),
+                    self.analyzer.segments
+                ))
+
+        self.close_file()
+
+
+class Margin(QLabel):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class Header(QLabel):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class ConnectButton(QPushButton):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class BrowseButton(QPushButton):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class AngleButton(QPushButton):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class GoButton(QPushButton):
+    def __init__(self, txt):
+        super().__init__(txt)
+
+
+class DetectThread(QtCore.QThread):
+    """ Runs detect_baudrate off the GUI thread """
+    def __init__(self):
+        super().__init__()
+
+        self.signal = DetectSignal()
+        self.port = None
+
+    def detect(self, port):
+        """
+
+        :param port:
+        """
+        self.port = port
+        self.start()
+
+    def run(self):
+        """ Emits the result of detect_baudrate, None on failure
+
+        """
+        try:
+            result = detect_baudrate(self.port)
+        except (serial.SerialException, OSError) as se:
+            print(se.args)
+            result = None
+
+        self.signal.detected.emit(result)
+
+
+class SpectrumDialog(QDialog):
+    # noinspection PyUnresolvedReferences
+    def __init__(self, imu_thread, parent):
+        super().__init__(
+            parent,
+            QtCore.Qt.Window |
+            QtCore.Qt.WindowTitleHint |
+            QtCore.Qt.WindowCloseButtonHint
+        )
 
+        self.imu_thread = imu_thread
+        self.spectrum_thread = None
 
-class PlatformThread(QtCore.QThread):
-    def __init__(self):
-        super().__init__()
+        menu = QHBoxLayout()
 
-        self.signal = PlatformSignal()
+        menu.addWidget(QLabel('Частота (Гц):'))
+        self.rate = QLineEdit(SPECTRUM_RATE)
+        self.rate.setAlignment(Qt.AlignRight)
+        self.rate.setValidator(QIntValidator(1, 10000))
+        menu.addWidget(self.rate)
 
-    def open_port(self, port, baudrate):
-        """
+        menu.addWidget(QLabel('Окно:'))
+        self.window_list = QComboBox(self)
+        for window in SPECTRUM_WINDOWS:
+            self.window_list.addItem(window)
+        self.window_list.setCurrentIndex(
+            SPECTRUM_WINDOWS.index(SPECTRUM_WINDOW)
+        )
+        menu.addWidget(self.window_list)
+
+        menu.addWidget(QLabel('Перекрытие (%):'))
+        self.overlap_list = QComboBox(self)
+        for overlap in SPECTRUM_OVERLAPS:
+            self.overlap_list.addItem(overlap)
+        self.overlap_list.setCurrentIndex(
+            SPECTRUM_OVERLAPS.index(SPECTRUM_OVERLAP)
+        )
+        menu.addWidget(self.overlap_list)
 
-        :param port:
-        :param baudrate:
-        """
-        self.ser = serial.Serial(port, baudrate)
+        self.start_button = GoButton('\U000025BA')
+        self.start_button.setToolTip('Запустить/остановить анализ')
+        self.start_button.setCheckable(True)
+        self.start_button.clicked.connect(self.start_analysis)
+        menu.addWidget(self.start_button)
 
-    def read_ser_data(self):
-        """
+        self.status = QLabel('')
+        menu.addWidget(self.status)
 
-        :return:
-        """
-        ser_data = self.ser.read()
+        from imu_spectrum import SPECTRUM_BANDS
 
-        return ser_data
+        table = QGridLayout()
+        table.addWidget(Header('Пик (Гц)'), 0, 1)
+        table.addWidget(Header('Пик (ед.²/Гц)'), 0, 2)
+        for column, (low, high) in enumerate(SPECTRUM_BANDS, 3):
+            table.addWidget(
+                Header('СКЗ {}-{} Гц'.format(low, high)), 0, column
+            )
 
-    def write_ser_data(self, data):
-        """
+        self.cells = []
+        for row, (_, title) in enumerate(SPECTRUM_CHANNELS, 1):
+            table.addWidget(QLabel(title), row, 0)
+            cells = []
+            for column in range(1, 3 + len(SPECTRUM_BANDS)):
+                cell = QLabel('-')
+                cell.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                table.addWidget(cell, row, column)
+                cells.append(cell)
+            self.cells.append(cells)
 
-        :param data:
-        """
-        self.ser.write(data)
+        layout = QVBoxLayout()
+        layout.addLayout(menu)
+        layout.addWidget(Interface.create_hline())
+        layout.addLayout(table)
+        self.setLayout(layout)
 
-    def run(self):
+        self.setWindowTitle('Спектр вибраций')
+
+    def start_analysis(self):
         """
 
         """
-        while True:
-            answer = self.read_ser_data()
-            if answer == MOVE_DONE:
-                self.signal.move_done.emit(True)
-            elif answer == ZERO_ALL:
-                print('All coordinates are zero.')
+        if self.spectrum_thread is not None:
+            self.stop_analysis()
+            return
 
+        try:
+            from imu_spectrum import SpectrumAnalyzer
 
-class Margin(QLabel):
-    def __init__(self, txt):
-        super().__init__(txt)
+            analyzer = SpectrumAnalyzer(
+                len(SPECTRUM_CHANNELS),
+                int(self.rate.text()),
+                int(self.window_list.currentText()),
+                int(self.overlap_list.currentText()) / 100
+            )
+        except (ImportError, ValueError) as e:
+            self.start_button.setChecked(False)
+            self.status.setText(str(e))
+            return
 
+        self.spectrum_thread = SpectrumThread(self.imu_thread, analyzer)
+        # noinspection PyUnresolvedReferences
+        self.spectrum_thread.signal.result.connect(self.show_result)
+        self.spectrum_thread.start()
 
-class Header(QLabel):
-    def __init__(self, txt):
-        super().__init__(txt)
+        self.imu_thread.spectrum_dropped = 0
+        self.imu_thread.spectrum_queue = self.spectrum_thread.batches
 
+        self.rate.setEnabled(False)
+        self.window_list.setEnabled(False)
+        self.overlap_list.setEnabled(False)
 
-class ConnectButton(QPushButton):
-    def __init__(self, txt):
-        super().__init__(txt)
+    def stop_analysis(self):
+        """
 
+        """
+        if self.spectrum_thread is None:
+            return
 
-class BrowseButton(QPushButton):
-    def __init__(self, txt):
-        super().__init__(txt)
+        self.imu_thread.spectrum_queue = None
+        self.spectrum_thread.stop_requested = True
+        self.spectrum_thread.wait()
+        self.spectrum_thread = None
 
+        self.start_button.setChecked(False)
+        self.rate.setEnabled(True)
+        self.window_list.setEnabled(True)
+        self.overlap_list.setEnabled(True)
 
-class AngleButton(QPushButton):
-    def __init__(self, txt):
-        super().__init__(txt)
+    def show_result(self, result):
+        """
 
+        :param result:
+        """
+        freqs, peaks, band_rms, segments = result
 
-class GoButton(QPushButton):
-    def __init__(self, txt):
-        super().__init__(txt)
+        for i, cells in enumerate(self.cells):
+            cells[0].setText('{:.2f}'.format(freqs[i]))
+            cells[1].setText('{:.3g}'.format(peaks[i]))
+            for cell, rms in zip(cells[2:], band_rms):
+                cell.setText('{:.3g}'.format(rms[i]))
+
+        self.status.setText('Сегментов: {}, потеряно отсчетов: {}'.format(
+            segments, self.imu_thread.spectrum_dropped
+        ))
+
+    # noinspection PyPep8Naming
+    def closeEvent(self, event):
+        self.stop_analysis()
+        super().closeEvent(event)
 
 
 class Interface(QDialog):
@@ -429,14 +1387,36 @@ class Interface(QDialog):
 
         self.imu_connection_state = False
         self.platform_connection_state = False
+        self.imu_port = None
         #        self.ports = (DEFAULT_PORT,)
         self.ports = get_ports()
 
         self.imu_thread = ImuReadThread()
         self.imu_thread.finished.connect(self.close_imu_port)
+        self.imu_thread.signal.disconnected.connect(
+            self.lose_imu_connection
+        )
+
+        self.detect_thread = DetectThread()
+        self.detect_thread.signal.detected.connect(self.finish_detection)
 
         self.platform_thread = PlatformThread()
         self.platform_thread.finished.connect(self.close_platform_port)
+        self.platform_thread.signal.disconnected.connect(
+            self.lose_platform_connection
+        )
+
+        self.positioning_thread = PositioningThread(
+            self.imu_thread,
+            self.platform_thread
+        )
+
+        self.spectrum_dialog = None
+
+        self.control_server = None
+        self.control_signal = ControlSignal()
+        # noinspection PyUnresolvedReferences
+        self.control_signal.command.connect(self.execute_command)
 
         self.initUI()
 
@@ -446,31 +1426,105 @@ class Interface(QDialog):
         :return:
         """
         port = self.imu_ports_list.currentText()
-        baudrate = int(self.imu_baud_list.currentText())
+        baudrate = self.imu_baud_list.currentText()
 
         if not port:
             return 1  # TODO: custom error handling here
 
+        if self.imu_connection_state:
+            self.disconnect_imu()
+        elif baudrate == AUTO_BAUD:
+            # connecting continues in finish_detection
+            self.imu_connect_button.setEnabled(False)
+            self.detect_thread.detect(port)
+        else:
+            self.open_imu(port, int(baudrate))
+
+    def finish_detection(self, detected):
+        """
+
+        :param detected:
+            The result of detect_baudrate
+        """
+        port = self.detect_thread.port
+        self.imu_connect_button.setEnabled(True)
+
+        if detected is None:
+            self.imu_connect_button.setChecked(False)
+            print('No IMU data on {}.'.format(port))
+            return
+
+        baudrate, packet_rate = detected
+        if packet_rate is None:
+            print('{}: {} baud.'.format(port, baudrate))
+        else:
+            print('{}: {} baud, {:.0f} packets/s.'.format(
+                port, baudrate, packet_rate
+            ))
+        self.open_imu(port, baudrate)
+
+    def open_imu(self, port, baudrate):
+        """
+
+        :param port:
+        :param baudrate:
+        """
         try:
-            if not self.imu_connection_state:
-                self.imu_thread.open_port(port, baudrate)
-                self.record_box.setEnabled(False)
+            if self.stream_box.isChecked():
+                self.imu_thread.start_stream()
 
-                if self.record_box.isChecked():
-                    self.imu_thread.create_file(self.file_path.text())
+            self.imu_port = port
+            self.imu_thread.set_offsets(profile_offsets(load_profile(port)))
 
-                self.imu_thread.start()
-                self.imu_thread.set_absolute_angle()
-                self.imu_connection_state = True
+            capture = None
+            if self.capture_box.isChecked():
+                capture = capture_path(self.file_path.text(), IMU_CAPTURE)
+
+            if self.process_box.isChecked():
+                self.imu_thread.open_process(port, baudrate, capture)
             else:
-                self.imu_thread.terminate()
-                self.imu_connection_state = False
-                self.record_box.setEnabled(True)
-                self.clear_lcds()
-        except serial.SerialException as se:
+                self.imu_thread.open_port(port, baudrate, capture)
+            self.record_box.setEnabled(False)
+            self.capture_box.setEnabled(False)
+            self.stream_box.setEnabled(False)
+            self.process_box.setEnabled(False)
+
+            if self.record_box.isChecked():
+                self.imu_thread.create_file(self.file_path.text())
+
+            self.imu_thread.start()
+            self.imu_thread.set_absolute_angle()
+            self.imu_connection_state = True
+            self.calibrate_button.setEnabled(True)
+        except (serial.SerialException, OSError) as se:
+            self.imu_thread.stop_stream()
             self.imu_connect_button.setChecked(False)
             print(se.args)
 
+    def disconnect_imu(self):
+        """
+
+        """
+        self.imu_thread.stop()
+        self.imu_thread.calibrator = None
+        self.imu_connection_state = False
+        self.calibrate_button.setEnabled(False)
+        self.record_box.setEnabled(True)
+        self.capture_box.setEnabled(True)
+        self.stream_box.setEnabled(True)
+        self.process_box.setEnabled(True)
+        self.clear_lcds()
+
+    def lose_imu_connection(self, message):
+        """ Resets the UI when reading stopped without a disconnect
+
+        :param message:
+        """
+        print(message)
+        if self.imu_connection_state:
+            self.imu_connect_button.setChecked(False)
+            self.disconnect_imu()
+
     def connect_platform(self):
         """
 
@@ -484,37 +1538,65 @@ class Interface(QDialog):
 
         try:
             if not self.platform_connection_state:
-                self.platform_thread.open_port(port, baudrate)
+                capture = None
+                if self.capture_box.isChecked():
+                    capture = capture_path(
+                        self.file_path.text(), PLATFORM_CAPTURE
+                    )
+                self.platform_thread.open_port(port, baudrate, capture)
                 self.platform_thread.start()
                 self.platform_go_button.setEnabled(True)
                 self.platform_zero_button.setEnabled(True)
+                self.target_button.setEnabled(True)
                 self.platform_connection_state = True
             else:
-                self.platform_thread.terminate()
-                self.platform_go_button.setEnabled(False)
-                self.platform_zero_button.setEnabled(False)
-                self.platform_connection_state = False
-        except serial.SerialException as se:
+                self.disconnect_platform()
+        except (serial.SerialException, OSError) as se:
             self.platform_connect_button.setChecked(False)
             print(se.args)
 
-    def close_imu_port(self):
+    def disconnect_platform(self):
+        """
+
         """
+        self.positioning_thread.stop_requested = True
+        self.platform_thread.stop()
+        self.platform_go_button.setEnabled(False)
+        self.platform_zero_button.setEnabled(False)
+        self.target_button.setEnabled(False)
+        self.platform_connection_state = False
+
+    def lose_platform_connection(self, message):
+        """ Resets the UI when the platform port failed
 
+        :param message:
+        """
+        print(message)
+        if self.platform_connection_state:
+            self.platform_connect_button.setChecked(False)
+            self.disconnect_platform()
+
+    def close_imu_port(self):
         """
-        self.imu_thread.ser.flush()
-        self.imu_thread.ser.close()
 
-        if self.record_box.isChecked():
-            self.imu_thread.fobject.flush()
-            self.imu_thread.fobject.close()
+        """
+        self.imu_thread.stop_recording()
+        self.imu_thread.stop_stream()
+        self.imu_thread.close_port()
 
     def close_platform_port(self):
         """
 
         """
-        self.platform_thread.ser.flush()
-        self.platform_thread.ser.close()
+        try:
+            self.platform_thread.ser.flush()
+        except (serial.SerialException, OSError):
+            # the port is gone, there is nothing left to send
+            pass
+        try:
+            self.platform_thread.ser.close()
+        except (serial.SerialException, OSError) as se:
+            print(se.args)
 
     def create_lcd(self, signal):
         """
@@ -537,6 +1619,45 @@ class Interface(QDialog):
         for lcd in self.findChildren(QLCDNumber):
             lcd.display(0)
 
+    def calibrate(self):
+        """
+
+        """
+        self.calibrate_button.setEnabled(False)
+        self.imu_thread.start_calibration()
+
+    def finish_calibration(self, profile):
+        """
+
+        :param profile:
+        """
+        self.calibrate_button.setEnabled(self.imu_connection_state)
+
+        if not profile['stationary']:
+            print('Sensor moved during calibration, noise: {}'.format(
+                profile['noise']
+            ))
+            return
+
+        save_profile(self.imu_port, profile)
+        self.imu_thread.set_offsets(profile_offsets(profile))
+        print('Calibration of {} saved, bias: {}'.format(
+            self.imu_port, profile['bias']
+        ))
+
+    def show_spectrum_dialog(self):
+        """
+
+        """
+        if self.spectrum_dialog is None:
+            try:
+                self.spectrum_dialog = SpectrumDialog(self.imu_thread, self)
+            except ImportError as e:
+                print(e.args)
+                return
+        self.spectrum_dialog.show()
+        self.spectrum_dialog.raise_()
+
     def show_select_dir_dialog(self):
         """
 
@@ -552,8 +1673,6 @@ class Interface(QDialog):
             self.file_path.setText(str(path))
 
     def send_coords(self):
-        message = '^MOVE,{},{},{},{}$'
-
         if not self.sync_box.isChecked():
             coord_1 = self.rod_1.text()
             coord_2 = self.rod_2.text()
@@ -565,18 +1684,301 @@ class Interface(QDialog):
             coord_3 = self.rod_3.text()
             coord_4 = '-' + self.rod_3.text()
 
-        message = message.format(coord_1, coord_2, coord_3, coord_4)
+        self.platform_thread.move((coord_1, coord_2, coord_3, coord_4))
+        self.platform_go_button.setEnabled(False)
+
+    def finish_move(self, done):
+        """ Enables GO after a move unless the positioning loop moves on
+
+        :param done:
+        """
+        if not self.positioning_thread.isRunning():
+            self.platform_go_button.setEnabled(done)
+
+    def go_to_target(self):
+        """
+
+        """
+        if self.positioning_thread.isRunning():
+            self.positioning_thread.stop_requested = True
+            return
+
+        if not self.imu_connection_state:
+            self.target_button.setChecked(False)
+            print('IMU is not connected.')
+            return
+
+        try:
+            self.positioning_thread.set_target(
+                float(self.target_x.text()),
+                float(self.target_y.text()),
+                float(self.target_tolerance.text()),
+                float(self.steps_in_degree.text()),
+                int(self.rod_1.text() or 0),
+                int(self.rod_3.text() or 0)
+            )
+        except ValueError:
+            self.target_button.setChecked(False)
+            return
 
-        self.platform_thread.write_ser_data(message.encode())
+        self.sync_box.setChecked(True)
         self.platform_go_button.setEnabled(False)
+        self.platform_zero_button.setEnabled(False)
+        self.positioning_thread.start()
+
+    def show_target_position(self, position_x, position_y):
+        """
+
+        :param position_x:
+        :param position_y:
+        """
+        self.rod_1.setText(str(position_x))
+        self.rod_3.setText(str(position_y))
+
+    def finish_target(self):
+        """
+
+        """
+        self.target_button.setChecked(False)
+        # after a stop the last move may still run, its move_done enables GO
+        self.platform_go_button.setEnabled(
+            self.platform_connection_state and
+            self.platform_thread.move_done_event.is_set()
+        )
+        self.platform_zero_button.setEnabled(self.platform_connection_state)
 
     def send_zero_all(self):
-        self.platform_thread.write_ser_data(b'^ZERO$')
+        self.platform_thread.zero()
+        self.platform_zero_button.setEnabled(False)
         self.rod_1.setText('0')
         self.rod_2.setText('0')
         self.rod_3.setText('0')
         self.rod_4.setText('0')
 
+    def enable_control(self, state):
+        """
+
+        :param state:
+        """
+        if state and self.control_server is None:
+            try:
+                self.control_server = ControlServer(self.dispatch_command)
+            except OSError as e:
+                self.control_box.setChecked(False)
+                print(e.args)
+        elif not state and self.control_server is not None:
+            self.control_server.close()
+            self.control_server = None
+
+    def dispatch_command(self, command):
+        """ Runs a remote command, called on the request thread
+
+        Waiting for the platform is done right here, everything else is
+        queued to the GUI thread. The timeout parameter is the whole wait,
+        the server has checked that it is a number.
+
+        :param command:
+        """
+        if command.name == 'wait_move_done':
+            timeout = command.params.get('timeout', DEFAULT_WAIT)
+            command.finish(self.platform_thread.move_done_event.wait(timeout))
+        elif command.name == 'get_position':
+            if not self.platform_connection_state:
+                command.fail('Platform is not connected')
+                return
+            timeout = command.params.get(
+                'timeout', RESPONSE_TIMEOUT * (Position.retries + 1)
+            )
+            command.finish(self.platform_thread.query_position(
+                timeout / (Position.retries + 1)
+            ))
+        else:
+            self.control_signal.command.emit(command)
+
+    def execute_command(self, command):
+        """
+
+        :param command:
+        """
+        handler = getattr(self, 'api_' + command.name, None)
+        if handler is None:
+            command.fail('Unknown command: ' + command.name)
+            return
+
+        try:
+            command.finish(handler(**command.params))
+        except (TypeError, ValueError, OSError, serial.SerialException) as e:
+            command.fail(e)
+
+    @staticmethod
+    def select_item(combo_box, text):
+        """
+
+        :param combo_box:
+        :param text:
+        """
+        index = combo_box.findText(str(text))
+        if index < 0:
+            raise ValueError('Unknown value: {}'.format(text))
+        combo_box.setCurrentIndex(index)
+
+    def api_connect_imu(self, state=True, port=None, baudrate=None,
+                        record=None, stream=None, capture=None):
+        """
+
+        :param state:
+        :param port:
+        :param baudrate:
+        :param record:
+        :param stream:
+        :param capture:
+        :return:
+            The connection state, with the automatic baudrate it becomes
+            True once the detection finishes
+        """
+        if self.detect_thread.isRunning():
+            raise ValueError('Baudrate detection in progress')
+
+        if state != self.imu_connection_state:
+            if port is not None:
+                self.select_item(self.imu_ports_list, port)
+            if baudrate is not None:
+                self.select_item(self.imu_baud_list, baudrate)
+            if record is not None:
+                self.record_box.setChecked(record)
+            if stream is not None:
+                self.stream_box.setChecked(stream)
+            if capture is not None:
+                self.capture_box.setChecked(capture)
+
+            self.imu_connect_button.setChecked(state)
+            self.connect_imu()
+
+        return self.imu_connection_state
+
+    def api_connect_platform(self, state=True, port=None, baudrate=None):
+        """
+
+        :param state:
+        :param port:
+        :param baudrate:
+        :return:
+        """
+        if state != self.platform_connection_state:
+            if port is not None:
+                self.select_item(self.platform_ports_list, port)
+            if baudrate is not None:
+                self.select_item(self.platform_baud_list, baudrate)
+
+            self.platform_connect_button.setChecked(state)
+            self.connect_platform()
+
+        return self.platform_connection_state
+
+    def api_send_coords(self, coords):
+        """
+
+        :param coords:
+            Positions of the four rods in steps
+        """
+        if self.positioning_thread.isRunning():
+            raise ValueError('Positioning in progress')
+        if not self.platform_go_button.isEnabled():
+            raise ValueError('Platform is not ready')
+
+        coords = [int(coord) for coord in coords]
+        if len(coords) != 4:
+            raise ValueError('Four coordinates expected')
+
+        self.sync_box.setChecked(False)
+        for rod, coord in zip(
+                (self.rod_1, self.rod_2, self.rod_3, self.rod_4), coords):
+            rod.setText(str(coord))
+
+        self.send_coords()
+
+    def api_send_zero_all(self):
+        """
+
+        """
+        if not self.platform_zero_button.isEnabled():
+            raise ValueError('Platform is not ready')
+
+        self.send_zero_all()
+
+    def api_set_relative_angle(self):
+        """
+
+        """
+        self.imu_thread.set_relative_angle()
+
+    def api_set_absolute_angle(self):
+        """
+
+        """
+        self.imu_thread.set_absolute_angle()
+
+    def api_calibrate(self):
+        """
+
+        """
+        if not self.calibrate_button.isEnabled():
+            raise ValueError('IMU is not ready')
+
+        self.calibrate()
+
+    def api_start_recording(self, path=None):
+        """
+
+        :param path:
+            Directory for the file, the selected one by default
+        :return:
+            The file name when connected, otherwise the recording starts
+            on the next connect
+        """
+        if path is not None:
+            if not os.path.isdir(path):
+                raise ValueError('No such directory: ' + path)
+            self.file_path.setText(path)
+
+        self.record_box.setChecked(True)
+
+        if self.imu_connection_state and not self.imu_thread.record_state:
+            return self.imu_thread.create_file(self.file_path.text())
+
+    def api_stop_recording(self):
+        """
+
+        """
+        self.record_box.setChecked(False)
+        self.imu_thread.stop_recording()
+
+    def api_status(self):
+        """
+
+        :return:
+        """
+        return {
+            'imu_connected': self.imu_connection_state,
+            'platform_connected': self.platform_connection_state,
+            'platform_ready': self.platform_go_button.isEnabled(),
+            'recording': self.imu_thread.record_state,
+            'missed': (
+                self.imu_thread.ring_reader.missed
+                if self.imu_thread.ring_reader is not None else 0
+            ),
+            'ring': (
+                self.imu_thread.ring.name
+                if self.imu_thread.ring is not None else None
+            ),
+            'imu_data': dict(zip(CHANNELS, self.imu_thread.sample)),
+            'start_angle': [
+                self.imu_thread.start_angle_x,
+                self.imu_thread.start_angle_y,
+                self.imu_thread.start_angle_z
+            ]
+        }
+
     @staticmethod
     def create_vline():
         """
@@ -645,6 +2047,23 @@ class Interface(QDialog):
         abs_angle_button.clicked.connect(self.imu_thread.set_absolute_angle)
         imu_menu.addWidget(abs_angle_button)
 
+        self.calibrate_button = AngleButton('К')
+        self.calibrate_button.setToolTip(
+            'Калибровка смещения нуля (датчик неподвижен, ось Z вверх)'
+        )
+        self.calibrate_button.setEnabled(False)
+        # noinspection PyUnresolvedReferences
+        self.calibrate_button.clicked.connect(self.calibrate)
+        # noinspection PyUnresolvedReferences
+        self.imu_thread.signal.calibrated.connect(self.finish_calibration)
+        imu_menu.addWidget(self.calibrate_button)
+
+        spectrum_button = AngleButton('\U0000223F')
+        spectrum_button.setToolTip('Спектр вибраций')
+        # noinspection PyUnresolvedReferences
+        spectrum_button.clicked.connect(self.show_spectrum_dialog)
+        imu_menu.addWidget(spectrum_button)
+
         imu_menu.addWidget(self.create_vline())
 
         self.imu_connect_button = ConnectButton('\U0001F50C')
@@ -666,9 +2085,9 @@ class Interface(QDialog):
         imu_menu.addWidget(QLabel('Скорость:'))
 
         self.imu_baud_list = QComboBox(self)
+        self.imu_baud_list.addItem(AUTO_BAUD)
         for baudrate in BAUDRATES:
             self.imu_baud_list.addItem(baudrate)
-        self.imu_baud_list.setCurrentIndex(BAUDRATES.index(IMU_BAUD))
         imu_menu.addWidget(self.imu_baud_list)
 
         imu_menu.addWidget(self.create_vline())
@@ -678,6 +2097,28 @@ class Interface(QDialog):
         self.record_box = QCheckBox()
         imu_menu.addWidget(self.record_box)
 
+        imu_menu.addWidget(QLabel('Сырые:'))
+
+        self.capture_box = QCheckBox()
+        self.capture_box.setToolTip(
+            'Запись сырых данных портов в файлы {}'.format(CAPTURE_EXT)
+        )
+        imu_menu.addWidget(self.capture_box)
+
+        imu_menu.addWidget(QLabel('Сеть:'))
+
+        self.stream_box = QCheckBox()
+        self.stream_box.setToolTip(
+            'Трансляция данных по TCP, порт {}'.format(STREAM_PORT)
+        )
+        imu_menu.addWidget(self.stream_box)
+
+        imu_menu.addWidget(QLabel('Проц.:'))
+
+        self.process_box = QCheckBox()
+        self.process_box.setToolTip('Чтение датчика в отдельном процессе')
+        imu_menu.addWidget(self.process_box)
+
         imu_menu.addWidget(QLabel('Путь:'))
 
         self.file_path = QLineEdit(os.getcwd())
@@ -730,6 +2171,10 @@ class Interface(QDialog):
         self.platform_zero_button.setToolTip('Обнулить координаты платформы')
         self.platform_zero_button.setEnabled(False)
         # noinspection PyUnresolvedReferences
+        self.platform_thread.signal.zero_done.connect(
+            self.platform_zero_button.setEnabled
+        )
+        # noinspection PyUnresolvedReferences
         self.platform_zero_button.clicked.connect(self.send_zero_all)
         platform_menu.addWidget(self.platform_zero_button)
 
@@ -737,9 +2182,7 @@ class Interface(QDialog):
         self.platform_go_button.setToolTip('Поехали')
         self.platform_go_button.setEnabled(False)
         # noinspection PyUnresolvedReferences
-        self.platform_thread.signal.move_done.connect(
-            self.platform_go_button.setEnabled
-        )
+        self.platform_thread.signal.move_done.connect(self.finish_move)
         # noinspection PyUnresolvedReferences
         self.platform_go_button.clicked.connect(self.send_coords)
         platform_menu.addWidget(self.platform_go_button)
@@ -827,6 +2270,71 @@ class Interface(QDialog):
         info.addWidget(QLabel('A = '))
         info.addWidget(self.label_4)
         info.addWidget(QLabel('мм;'))
+        info.addWidget(self.create_vline())
+        info.addWidget(QLabel('API:'))
+
+        self.control_box = QCheckBox()
+        self.control_box.setToolTip(
+            'Удаленное управление по HTTP, порт {}'.format(CONTROL_PORT)
+        )
+        # noinspection PyUnresolvedReferences
+        self.control_box.toggled.connect(self.enable_control)
+        info.addWidget(self.control_box)
+
+        # ___________________________TARGET____________________________________
+
+        angle_validator = QDoubleValidator(-90.0, 90.0, 2)
+        tolerance_validator = QDoubleValidator(0.01, 10.0, 2)
+        steps_in_degree_validator = QDoubleValidator(-99999.0, 99999.0, 1)
+
+        target = QHBoxLayout()
+        target.addWidget(QLabel('Угол (гр.):'))
+
+        target.addWidget(QLabel('X'))
+        self.target_x = QLineEdit('0.0')
+        self.target_x.setAlignment(Qt.AlignRight)
+        self.target_x.setValidator(angle_validator)
+        target.addWidget(self.target_x)
+
+        target.addWidget(QLabel('Y'))
+        self.target_y = QLineEdit('0.0')
+        self.target_y.setAlignment(Qt.AlignRight)
+        self.target_y.setValidator(angle_validator)
+        target.addWidget(self.target_y)
+
+        target.addWidget(QLabel('Допуск:'))
+        self.target_tolerance = QLineEdit(POSITION_TOLERANCE)
+        self.target_tolerance.setAlignment(Qt.AlignRight)
+        self.target_tolerance.setValidator(tolerance_validator)
+        target.addWidget(self.target_tolerance)
+
+        target.addWidget(QLabel('Шагов на гр.:'))
+        self.steps_in_degree = QLineEdit(STEPS_PER_DEGREE)
+        self.steps_in_degree.setAlignment(Qt.AlignRight)
+        self.steps_in_degree.setValidator(steps_in_degree_validator)
+        target.addWidget(self.steps_in_degree)
+
+        self.target_button = GoButton('\U00002316')
+        self.target_button.setToolTip('Выйти на угол по датчику')
+        self.target_button.setCheckable(True)
+        self.target_button.setEnabled(False)
+        # noinspection PyUnresolvedReferences
+        self.target_button.clicked.connect(self.go_to_target)
+        target.addWidget(self.target_button)
+
+        self.target_status = QLabel('')
+        self.target_status.setFixedWidth(150)
+        # noinspection PyUnresolvedReferences
+        self.positioning_thread.signal.status.connect(
+            self.target_status.setText
+        )
+        # noinspection PyUnresolvedReferences
+        self.positioning_thread.signal.position.connect(
+            self.show_target_position
+        )
+        # noinspection PyUnresolvedReferences
+        self.positioning_thread.signal.done.connect(self.finish_target)
+        target.addWidget(self.target_status)
 
         # ___________________________VALUES TABLE______________________________
 
@@ -871,11 +2379,13 @@ class Interface(QDialog):
         layout.addWidget(self.create_hline())
         layout.addLayout(info)
         layout.addWidget(self.create_hline())
+        layout.addLayout(target)
+        layout.addWidget(self.create_hline())
         layout.addLayout(table)
 
         self.setLayout(layout)
 
-        self.setFixedSize(750, 400)
+        self.setFixedSize(750, 430)
         self.setWindowTitle('MPU6050')
         self.show()
 
@@ -895,6 +2405,8 @@ class Interface(QDialog):
 
 # noinspection PyCallByClass,PyArgumentList
 def main():
+    multiprocessing.freeze_support()
+
     pyqt = os.path.dirname(PyQt5.__file__)
     # noinspection PyTypeChecker
     QApplication.addLibraryPath(os.path.join(pyqt, 'plugins'))
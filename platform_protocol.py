@@ -0,0 +1,351 @@
+""" Serial protocol of the platform controller
+
+Commands are framed as ``^NAME,arg,...$``. The controller answers a move
+with the single byte ``M`` and a reset of the coordinates with ``X``;
+other replies are framed the same way as commands::
+
+    ^POS,1200,-1200,0,0$    position of the four rods in steps
+    ^STATUS,IDLE,...$       controller state
+    ^ERR,3,Limit switch$    error code and message
+
+A printable byte outside a frame other than a bare ``M`` or ``X`` is the
+rest of a frame that lost its start, the parser drops it up to the next
+``$``. ``M`` and ``X`` followed by such a byte are dropped the same way,
+so ``STATUS,MOVING$`` does not complete a move.
+
+PlatformProtocol writes commands and parses replies from buffered reads.
+Several requests may be outstanding at a time, every reply completes the
+oldest pending request that expects it. Error replies carry no command
+name, so an error completes the oldest pending move if there is one and
+the oldest pending request of any kind otherwise: a query sent while the
+platform moves can not take the error of the move.
+"""
+import threading
+import collections
+
+FRAME_START = ord('^')
+FRAME_END = ord('$')
+MOVE_DONE = ord('M')
+ZERO_ALL = ord('X')
+# bytes of the names and the fields of framed replies
+FIELD_BYTES = frozenset(range(0x20, 0x7F)) - {FRAME_START, FRAME_END}
+
+RESPONSE_TIMEOUT = 1
+RETRIES = 2
+MAX_FRAME = 256
+ROD_COUNT = 4
+UNKNOWN_ERROR = -1
+
+
+class Command:
+    name = ''
+    response = None
+    retries = 0
+    # error replies go to these commands first
+    claims_errors = False
+
+    def __init__(self, *args):
+        """
+
+        :param args:
+            Command arguments
+        """
+        self.args = args
+
+    def encode(self):
+        """
+
+        :return:
+        """
+        fields = [self.name] + [str(arg) for arg in self.args]
+        return ('^' + ','.join(fields) + '$').encode()
+
+
+class Response:
+    def __init__(self, *args):
+        """
+
+        :param args:
+            Reply fields after the name
+        """
+        self.args = args
+
+    def __repr__(self):
+        return '{}{}'.format(type(self).__name__, self.args)
+
+
+class MoveDone(Response):
+    pass
+
+
+class ZeroDone(Response):
+    pass
+
+
+class PositionReply(Response):
+    def __init__(self, *args):
+        """
+
+        :param args:
+            Positions of the rods
+        :raises ValueError:
+            If the positions are not ROD_COUNT integers
+        """
+        if len(args) != ROD_COUNT:
+            raise ValueError('Expected {} positions'.format(ROD_COUNT))
+        super().__init__(*args)
+        self.coords = [int(arg) for arg in args]
+
+
+class StatusReply(Response):
+    pass
+
+
+class ErrorReply(Response):
+    def __init__(self, *args):
+        """ An error without a numeric code gets UNKNOWN_ERROR and keeps
+        all the fields as the message
+
+        :param args:
+            Error code and message
+        """
+        super().__init__(*args)
+        try:
+            self.code = int(args[0])
+            self.message = ','.join(args[1:])
+        except (IndexError, ValueError):
+            self.code = UNKNOWN_ERROR
+            self.message = ','.join(args)
+
+
+class UnknownReply(Response):
+    pass
+
+
+class Move(Command):
+    name = 'MOVE'
+    response = MoveDone
+    claims_errors = True
+
+    def __init__(self, coords):
+        """
+
+        :param coords:
+            Target positions of the four rods in steps
+        """
+        super().__init__(*coords)
+
+
+class Zero(Command):
+    name = 'ZERO'
+    response = ZeroDone
+
+
+class Position(Command):
+    name = 'POS'
+    response = PositionReply
+    retries = RETRIES
+
+
+class Status(Command):
+    name = 'STATUS'
+    response = StatusReply
+    retries = RETRIES
+
+
+FRAMED_RESPONSES = {
+    'POS': PositionReply,
+    'STATUS': StatusReply,
+    'ERR': ErrorReply,
+    'M': MoveDone,
+    'X': ZeroDone
+}
+
+
+class ResponseParser:
+    def __init__(self):
+        self.buffer = bytearray()
+        # inside a frame that lost its start
+        self.skipping = False
+
+    def feed(self, data):
+        """
+
+        :param data:
+            Bytes read from the port
+        :returns:
+            A list of the complete responses
+        """
+        self.buffer += data
+        responses = []
+        position = 0
+        buffer = self.buffer
+
+        while position < len(buffer):
+            byte = buffer[position]
+
+            if self.skipping:
+                if byte != FRAME_START:
+                    position += 1
+                self.skipping = byte not in (FRAME_START, FRAME_END)
+            elif byte == FRAME_START:
+                end = buffer.find(FRAME_END, position + 1)
+                if end < 0:
+                    if len(buffer) - position > MAX_FRAME:
+                        position = len(buffer)
+                    break
+                responses.append(self.parse_frame(buffer[position + 1:end]))
+                position = end + 1
+            elif byte in (MOVE_DONE, ZERO_ALL) and (
+                    position + 1 == len(buffer) or
+                    buffer[position + 1] not in FIELD_BYTES):
+                responses.append(
+                    MoveDone() if byte == MOVE_DONE else ZeroDone()
+                )
+                position += 1
+            else:
+                self.skipping = byte in FIELD_BYTES
+                position += 1
+
+        del buffer[:position]
+        return responses
+
+    @staticmethod
+    def parse_frame(frame):
+        """
+
+        :param frame:
+            Frame contents without the delimiters
+        :returns:
+            The response, UnknownReply if the name or the fields are not
+            recognised
+        """
+        name, *args = frame.decode('ascii', 'replace').split(',')
+        response = FRAMED_RESPONSES.get(name)
+        if response is not None:
+            try:
+                return response(*args)
+            except ValueError:
+                pass
+        return UnknownReply(name, *args)
+
+
+class Request:
+    def __init__(self, command):
+        """
+
+        :param command:
+        """
+        self.command = command
+        self.response = None
+        self.done = threading.Event()
+
+    def wait(self, timeout):
+        """
+
+        :param timeout:
+        :returns:
+            The response or None on timeout
+        """
+        if self.done.wait(timeout):
+            return self.response
+        return None
+
+
+class PlatformProtocol:
+    def __init__(self, ser):
+        """
+
+        :param ser:
+            An open serial.Serial
+        """
+        self.ser = ser
+        self.parser = ResponseParser()
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
+    def send(self, command):
+        """ Writes a command without waiting for the reply
+
+        :param command:
+        :returns:
+            A Request completed by the reply
+        """
+        request = Request(command)
+
+        with self.lock:
+            if command.response is not None:
+                self.pending.append(request)
+            self.ser.write(command.encode())
+
+        return request
+
+    def request(self, command, timeout=RESPONSE_TIMEOUT):
+        """ Sends a command and waits for the reply, resending it up to
+        command.retries times
+
+        :param command:
+        :param timeout:
+            Time to wait for each attempt in seconds
+        :returns:
+            The response or None if all attempts timed out
+        """
+        for _ in range(command.retries + 1):
+            request = self.send(command)
+            response = request.wait(timeout)
+            if response is not None:
+                return response
+            self.cancel(request)
+
+        return None
+
+    def cancel(self, request):
+        """
+
+        :param request:
+        """
+        with self.lock:
+            try:
+                self.pending.remove(request)
+            except ValueError:
+                pass
+
+    def match(self, response):
+        """
+
+        :param response:
+        """
+        with self.lock:
+            if isinstance(response, ErrorReply):
+                candidates = [
+                    request for request in self.pending
+                    if request.command.claims_errors
+                ] or self.pending
+            else:
+                candidates = [
+                    request for request in self.pending
+                    if isinstance(response, request.command.response)
+                ]
+            if not candidates:
+                return
+
+            request = candidates[0]
+            self.pending.remove(request)
+
+        request.response = response
+        request.done.set()
+
+    def poll(self):
+        """ Reads whatever the port has, blocking for at least one byte or
+        the timeout of the port
+
+        :returns:
+            A list of the responses received
+        """
+        data = self.ser.read(max(1, self.ser.in_waiting))
+        responses = self.parser.feed(data)
+
+        for response in responses:
+            self.match(response)
+
+        return responses